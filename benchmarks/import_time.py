@@ -0,0 +1,91 @@
+"""
+Check how long it takes to start the app, and that slow modules aren't loaded
+
+Each run starts a new python process which imports the app and calls
+`create_app`, like any `flask` command does. Flask itself is imported
+first and timed separately, as the app can't start without it. Fails if
+the median time for the rest is over the budget, or if any of the slow
+modules are imported. Run from the root of the repository with:
+
+    python benchmarks/import_time.py
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should only be imported by the commands and routes using them
+SLOW_MODULES = [
+    "elasticsearch",
+    "graphqlclient",
+    "pdfplumber",
+    "requests_cache",
+    "sentry_sdk",
+    "slugify",
+]
+
+CREATE_APP = """
+import json, sys, time
+start = time.perf_counter()
+import flask
+flask_loaded = time.perf_counter()
+from docdisplay import create_app
+create_app()
+print(json.dumps({
+    "flask": flask_loaded - start,
+    "seconds": time.perf_counter() - flask_loaded,
+    "modules": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+def time_create_app():
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    env.pop("SENTRY_DSN", None)
+    result = subprocess.run(
+        [sys.executable, "-c", CREATE_APP % SLOW_MODULES],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=200,
+        help="Most milliseconds the app can take to start, after importing flask",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs")
+    args = parser.parse_args()
+
+    runs = [time_create_app() for _ in range(args.runs)]
+    median = statistics.median(r["seconds"] for r in runs) * 1000
+    slow_modules = sorted({m for r in runs for m in r["modules"]})
+    print(
+        "flask: {:.0f} ms, create_app: {:.0f} ms (budget {:.0f} ms)".format(
+            statistics.median(r["flask"] for r in runs) * 1000, median, args.budget
+        )
+    )
+
+    failed = False
+    if median > args.budget:
+        print("FAIL: starting the app took longer than the budget")
+        failed = True
+    if slow_modules:
+        print("FAIL: slow modules imported: {}".format(", ".join(slow_modules)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+"""
+Benchmarks for fetching, extracting and searching accounts
+
+Everything runs offline: regulator pages come from `benchmarks/fixtures`,
+PDFs are generated and elasticsearch is replaced with a fake that returns
+the responses it would give. Run from the root of the repository with:
+
+    python benchmarks/suite.py run --output results.json
+
+and compare two sets of results with:
+
+    python benchmarks/suite.py compare before.json results.json
+"""
+import argparse
+import datetime
+import functools
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import render_template  # noqa: E402
+
+from docdisplay import create_app  # noqa: E402
+from docdisplay.fetch import CCEW, CCNI, OSCR  # noqa: E402
+from docdisplay.upload import convert_file, upload_doc  # noqa: E402
+from docdisplay.utils import get_nav  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# saved page, regulator, charity number and the URL the page came from
+LISTING_FIXTURES = [
+    (
+        "ccew_205846.html",
+        CCEW(api_key=None, organisation_numbers={"205846": 205846}),
+        "205846",
+        "https://register-of-charities.charitycommission.gov.uk"
+        "/charity-search/-/charity-details/205846/accounts-and-annual-returns",
+    ),
+    (
+        "ccni_100002.html",
+        CCNI(),
+        "NI100002",
+        "https://www.charitycommissionni.org.uk/charity-details/?regId=100002&subId=0",
+    ),
+    (
+        "oscr_SC000001.html",
+        OSCR(),
+        "SC000001",
+        "https://www.oscr.org.uk/about-charities/search-the-register/charity-details?number=1",
+    ),
+]
+
+# number of pages in each PDF that text is extracted from
+PDF_PAGES = [1, 5, 20]
+
+# slowdowns of more than this percentage are reported by `compare`
+DEFAULT_THRESHOLD = 20
+
+
+class FixtureResponse:
+    def __init__(self, content: bytes, url: str):
+        self.content = content
+        self.url = url
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+
+class FixtureSession:
+    """
+    Session which returns a saved page for any URL
+    """
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def get(self, url, **kwargs):
+        return FixtureResponse(self.content, url)
+
+
+class FakeTransport:
+    def __init__(self):
+        from elasticsearch.serializer import JSONSerializer
+
+        self.serializer = JSONSerializer()
+
+
+class FakeElasticsearch:
+    """
+    Stand-in for the elasticsearch client, giving the responses of a new index
+    """
+
+    def __init__(self):
+        self.transport = FakeTransport()
+
+    def index(self, index, doc_type, id, body, **kwargs):
+        self.transport.serializer.dumps(body)
+        return {"_index": index, "_type": doc_type, "_id": id, "result": "created"}
+
+    def bulk(self, body, **kwargs):
+        lines = body.splitlines()
+        items = []
+        for line in lines[::2]:
+            op_type, action = json.loads(line).popitem()
+            items.append({op_type: {**action, "result": "created", "status": 201}})
+        return {"took": 1, "errors": False, "items": items}
+
+
+def make_pdf(pages: int, lines_per_page: int = 40) -> bytes:
+    """
+    Create a PDF with a page of text for each page
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(4 + (i * 2)) for i in range(pages)), pages
+        ).encode("ascii"),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page in range(pages):
+        text = "".join(
+            "({}) Tj T* ".format(
+                "Page {} line {}: income and expenditure for the year "
+                "ended 31 March 2022 was 12,345".format(page + 1, line + 1)
+            )
+            for line in range(lines_per_page)
+        )
+        stream = "BT /F1 10 Tf 12 TL 50 800 Td {}ET".format(text).encode("ascii")
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            "/Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>".format(
+                5 + (page * 2)
+            ).encode("ascii")
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+
+    pdf = io.BytesIO()
+    pdf.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(pdf.tell())
+        pdf.write(b"%d 0 obj\n%s\nendobj\n" % (i, obj))
+    xref = pdf.tell()
+    pdf.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        pdf.write(b"%010d 00000 n \n" % offset)
+    pdf.write(
+        b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+        % (len(objects) + 1, xref)
+    )
+    return pdf.getvalue()
+
+
+def extract_pdf(pdf: bytes) -> dict:
+    return convert_file(io.BytesIO(pdf))
+
+
+def get_search_results(count: int = 10) -> list:
+    return [
+        {
+            "_id": "{}-20220331".format(100000 + i),
+            "_source": {"regno": str(100000 + i), "fye": "2022-03-31T00:00:00"},
+            "sort": [1.5 - (i / 100), "{}-20220331".format(100000 + i)],
+            "highlight": {
+                "attachment.content": [
+                    "the <em class='bg-yellow b highlight'>income</em> of the "
+                    "charity   for the year\n\n was 12,345"
+                ]
+                * 3
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def get_benchmarks() -> list:
+    """
+    Get the name and function to time for each benchmark
+    """
+    benchmarks = []
+    for filename, regulator, regno, url in LISTING_FIXTURES:
+        with open(os.path.join(FIXTURES_DIR, filename), "rb") as f:
+            session = FixtureSession(f.read())
+        benchmarks.append(
+            (
+                "list_accounts[{}]".format(regulator.name),
+                functools.partial(regulator.list_accounts, regno, session=session),
+            )
+        )
+
+    for pages in PDF_PAGES:
+        benchmarks.append(
+            (
+                "convert_file[{} pages]".format(pages),
+                functools.partial(extract_pdf, make_pdf(pages)),
+            )
+        )
+
+    benchmarks.append(
+        (
+            "upload_doc[{} pages]".format(PDF_PAGES[1]),
+            functools.partial(
+                upload_doc,
+                {"regno": "205846", "fye": datetime.date(2022, 3, 31)},
+                make_pdf(PDF_PAGES[1]),
+                FakeElasticsearch(),
+            ),
+        )
+    )
+
+    results = get_search_results()
+    nav_args = (3, 10, 1234, "doc.doc_search", {"q": "income"})
+    benchmarks.append(("get_nav", functools.partial(get_nav, *nav_args, results)))
+    benchmarks.append(
+        (
+            "render[doc_search]",
+            functools.partial(
+                render_template,
+                "doc_search.html.j2",
+                results=results,
+                q="income",
+                resultCount=1234,
+                nav=get_nav(*nav_args, results=results),
+                downloadUrl="/doc/search.csv?q=income",
+                downloadJsonUrl="/doc/search.jsonl?q=income",
+            ),
+        )
+    )
+    return benchmarks
+
+
+def time_benchmark(func, repeat: int) -> dict:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "number": number,
+        "repeat": repeat,
+    }
+
+
+def run(args):
+    app = create_app(
+        {
+            "ES_URL": None,
+            "BLOB_STORE": None,
+            "QUERY_CACHE_SIZE": 0,
+            "EXTRACT_WORKERS": None,
+        }
+    )
+    results = {}
+    with app.test_request_context("/doc/search?q=income"):
+        for name, func in get_benchmarks():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = time_benchmark(func, args.repeat)
+            print(
+                "{:<28} {:>12.3f} ms".format(name, results[name]["min"] * 1000),
+                file=sys.stderr,
+            )
+
+    output = {
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)["benchmarks"]
+    with open(args.after) as f:
+        after = json.load(f)["benchmarks"]
+
+    slower = []
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print("{:<28} {}".format(name, "new" if name not in before else "removed"))
+            continue
+        change = (after[name][args.stat] / before[name][args.stat] - 1) * 100
+        flag = ""
+        if change > args.threshold:
+            flag = "SLOWER"
+            slower.append(name)
+        elif change < -args.threshold:
+            flag = "faster"
+        print(
+            "{:<28} {:>10.3f} ms {:>10.3f} ms {:>+7.1f}% {}".format(
+                name,
+                before[name][args.stat] * 1000,
+                after[name][args.stat] * 1000,
+                change,
+                flag,
+            ).rstrip()
+        )
+    if slower:
+        print("{} benchmarks more than {}% slower".format(len(slower), args.threshold))
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument("--output", help="File to save the results as JSON")
+    run_parser.add_argument(
+        "--repeat", type=int, default=5, help="Number of times to time each benchmark"
+    )
+    run_parser.add_argument(
+        "--filter", help="Only run benchmarks with names containing this"
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two sets of results"
+    )
+    compare_parser.add_argument("before", help="Results to compare against")
+    compare_parser.add_argument("after", help="New results")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Percentage slowdown to report",
+    )
+    compare_parser.add_argument(
+        "--stat",
+        choices=["min", "median"],
+        default="min",
+        help="Which time to compare",
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,21 @@ import datetime
 import os
 import re
 
-import sentry_sdk
 from flask import Flask, render_template
-from sentry_sdk.integrations.flask import FlaskIntegration
 
 from . import blueprints as bp
-from . import db
+from . import db, metrics
 from .auth import basic_auth
 from .fetch import fetch_cli
+from .http_cache import DEFAULT_HTTP_CACHE_POLICIES, DEFAULT_HTTP_TIMEOUT
+from .throttle import DEFAULT_HOST_RATES
 from .utils import parse_datetime
 
 if os.environ.get("SENTRY_DSN"):
+    # the sentry SDK is slow to import, so is only loaded when it is used
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+
     sentry_sdk.init(
         dsn=os.environ.get("SENTRY_DSN"),
         integrations=[FlaskIntegration()],
@@ -31,12 +35,78 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         ES_URL=os.environ.get("ELASTICSEARCH_URL"),
         ES_INDEX="charityaccounts",
+        # connections to elasticsearch are shared by all requests in a process
+        ES_POOL_MAXSIZE=int(os.environ.get("ES_POOL_MAXSIZE", 10)),
+        ES_TIMEOUT=int(os.environ.get("ES_TIMEOUT", 10)),
+        ES_MAX_RETRIES=int(os.environ.get("ES_MAX_RETRIES", 3)),
+        ES_RETRY_ON_TIMEOUT=os.environ.get("ES_RETRY_ON_TIMEOUT", "true").lower()
+        in ("true", "1", "yes"),
+        # seconds to wait for each type of request, unless a call sets its own
+        ES_REQUEST_TIMEOUTS={
+            "_search": 10,
+            "_count": 5,
+            "_mget": 30,
+            "_bulk": 120,
+            "_reindex": 60,
+            "_delete_by_query": 120,
+        },
+        # each page of a document is also indexed separately
+        ES_PAGES_INDEX="charityaccounts-pages",
+        # local copy of the charity register, used for searching charities
+        ES_CHARITY_INDEX="charityaccounts-charities",
         CHARITYBASE_API_URL=os.environ.get(
             "CHARITYBASE_API_URL", "https://charitybase.uk/api/graphql"
         ),
         CHARITYBASE_API_KEY=os.environ.get("CHARITYBASE_API_KEY"),
         CCEW_API_KEY=os.environ.get("CCEW_API_KEY"),
         FILE_SIZE_LIMT=(1024**2) * 10,  # limit file size to upload - 10MB
+        # where PDF files are stored - see docdisplay.blobstore. If not set
+        # they are kept in elasticsearch
+        BLOB_STORE=os.environ.get("BLOB_STORE"),
+        BLOB_STORE_OPTIONS={
+            "root": os.environ.get(
+                "BLOB_STORE_PATH", os.path.join(app.instance_path, "blobs")
+            )
+        },
+        # number of processes used to extract text from large PDFs
+        EXTRACT_WORKERS=int(os.environ.get("EXTRACT_WORKERS", 0)) or None,
+        # seconds to wait for each source of data on the charity page
+        CHARITY_FETCH_TIMEOUTS={"documents": 5, "accounts": 10, "charity": 10},
+        # cache of the accounts listed by each regulator
+        LISTING_CACHE_PATH=os.environ.get(
+            "LISTING_CACHE_PATH", os.path.join(app.instance_path, "listings.sqlite")
+        ),
+        LISTING_CACHE_TTL=int(os.environ.get("LISTING_CACHE_TTL", 60 * 60 * 24)),
+        LISTING_CACHE_EMPTY_TTL=int(os.environ.get("LISTING_CACHE_EMPTY_TTL", 60 * 15)),
+        # cache of search results - set QUERY_CACHE_SIZE to 0 to turn it off
+        QUERY_CACHE_SIZE=int(os.environ.get("QUERY_CACHE_SIZE", 1024)),
+        QUERY_CACHE_TTL=int(os.environ.get("QUERY_CACHE_TTL", 300)),
+        # share cached results between processes - see docdisplay.query_cache
+        QUERY_CACHE_BACKEND=os.environ.get("QUERY_CACHE_BACKEND"),
+        QUERY_CACHE_BACKEND_OPTIONS={
+            "path": os.environ.get(
+                "QUERY_CACHE_PATH", os.path.join(app.instance_path, "queries.sqlite")
+            )
+        },
+        # how responses from other websites are cached - see docdisplay.http_cache
+        HTTP_CACHE_POLICIES=DEFAULT_HTTP_CACHE_POLICIES,
+        HTTP_CACHE_PATH=os.environ.get(
+            "HTTP_CACHE_PATH", os.path.join(app.instance_path, "http_cache")
+        ),
+        # requests per second to each website - see docdisplay.throttle
+        HOST_RATE_LIMITS=DEFAULT_HOST_RATES,
+        # retries when a website is overloaded or can't be reached
+        HTTP_RETRIES=int(os.environ.get("HTTP_RETRIES", 3)),
+        HTTP_BACKOFF_FACTOR=float(os.environ.get("HTTP_BACKOFF_FACTOR", 1)),
+        HTTP_MAX_RETRY_AFTER=int(os.environ.get("HTTP_MAX_RETRY_AFTER", 120)),
+        # seconds to connect, and to wait between bytes received, when
+        # listing accounts or calling the Charity Commission API
+        HTTP_TIMEOUT=(
+            float(os.environ.get("HTTP_CONNECT_TIMEOUT", DEFAULT_HTTP_TIMEOUT[0])),
+            float(os.environ.get("HTTP_READ_TIMEOUT", DEFAULT_HTTP_TIMEOUT[1])),
+        ),
+        # send metrics from commands to a Prometheus pushgateway - see docdisplay.metrics
+        PROMETHEUS_PUSHGATEWAY=os.environ.get("PROMETHEUS_PUSHGATEWAY"),
         BASIC_AUTH_USERNAME=os.environ.get("BASIC_AUTH_USERNAME", "user"),
         BASIC_AUTH_PASSWORD=os.environ.get("BASIC_AUTH_PASSWORD"),
     )
@@ -56,6 +126,7 @@ def create_app(test_config=None):
 
     basic_auth.init_app(app)
     db.init_app(app)
+    metrics.init_app(app)
     bp.init_app(app)
     app.cli.add_command(fetch_cli)
 
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+_create_lock = threading.Lock()
+
+
+class BlobNotFoundError(Exception):
+    pass
+
+
+class BlobStore:
+    """
+    Base class for storing PDF files outside elasticsearch
+
+    Files are stored by the SHA-256 hash of their contents, so the same
+    file is only stored once.
+    """
+
+    @staticmethod
+    def get_key(content: bytes) -> str:
+        return hashlib.sha256(content).hexdigest()
+
+    def put(self, content: bytes) -> str:
+        """
+        Store a file and return its key
+        """
+        raise NotImplementedError
+
+    def open(self, key: str):
+        """
+        Open a stored file for reading in binary mode
+        """
+        raise NotImplementedError
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def get_path(self, key: str) -> str:
+        """
+        Get the path of a stored file on the local filesystem, if it has one
+        """
+        return None
+
+    def get(self, key: str) -> bytes:
+        with self.open(key) as f:
+            return f.read()
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Store files in a folder on the local filesystem
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        # spread the files across subfolders so no folder gets too big
+        return os.path.join(self.root, key[0:2], key[2:4], key)
+
+    def put(self, content: bytes) -> str:
+        key = self.get_key(content)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so a partial file is never seen
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return key
+
+    def open(self, key: str):
+        try:
+            return open(self.path(key), "rb")
+        except FileNotFoundError:
+            raise BlobNotFoundError("File {} not found".format(key))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def get_path(self, key: str) -> str:
+        if not self.exists(key):
+            raise BlobNotFoundError("File {} not found".format(key))
+        return self.path(key)
+
+
+BLOB_STORES = {
+    "local": LocalBlobStore,
+}
+
+
+def get_blob_store():
+    """
+    Get the blob store configured for the app
+
+    `BLOB_STORE` is either the name of one of `BLOB_STORES` or the import
+    path of another `BlobStore` class, which is created using
+    `BLOB_STORE_OPTIONS`. If it isn't set then PDFs are kept in
+    elasticsearch.
+    """
+    if not current_app.config.get("BLOB_STORE"):
+        return None
+    with _create_lock:
+        if "blob_store" not in current_app.extensions:
+            store_class = current_app.config["BLOB_STORE"]
+            store_class = BLOB_STORES.get(store_class) or import_string(store_class)
+            current_app.extensions["blob_store"] = store_class(
+                **current_app.config.get("BLOB_STORE_OPTIONS", {})
+            )
+    return current_app.extensions["blob_store"]
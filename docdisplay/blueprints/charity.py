@@ -1,23 +1,98 @@
 import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
-from flask import Blueprint, abort, current_app, render_template, request, url_for
-from graphqlclient import GraphQLClient
+import click
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    flash,
+    jsonify,
+    render_template,
+    request,
+    url_for,
+)
+from tqdm import tqdm
 
-from docdisplay.db import get_db
+from docdisplay.db import (
+    INDEXES,
+    ReindexError,
+    bulk_load_settings,
+    get_alias_indexes,
+    get_cached_db,
+    get_db,
+    get_index_name,
+    swap_alias,
+)
 from docdisplay.fetch import Account, get_charity_type
+from docdisplay.metrics import push_metrics_after
+from docdisplay.query_cache import clear_query_cache
+from docdisplay.register import (
+    get_charities,
+    load_register,
+    read_register,
+    search_register,
+)
 from docdisplay.utils import get_nav
 
 CC_ACCOUNT_FILENAME = r"([0-9]+)_AC_([0-9]{4})([0-9]{2})([0-9]{2})_E_C.PDF"
 
 bp = Blueprint("charity", __name__, url_prefix="/charity")
 
+# shared between requests so that fetches which time out don't hold up
+# the response while they finish
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="charity_get")
+
+# seconds to remember whether the local charity register has been loaded
+REGISTER_CHECK_TTL = 60
+
 
 def search_charities(q, limit=20, skip=0):
+    """
+    Search for charities in the local register, or CharityBase if it isn't loaded
+    """
+    from elasticsearch import TransportError
+
     if not q:
         return {
             "count": 0,
             "results": [],
         }
+    index = current_app.config.get("ES_CHARITY_INDEX")
+    try:
+        if register_loaded(index):
+            return search_register(get_cached_db(), index, q, limit, skip)
+    except TransportError:
+        logging.exception("Could not search the local charity register")
+    return search_charitybase(q, limit, skip)
+
+
+def register_loaded(index: str) -> bool:
+    """
+    Check whether the local register has any charities in it
+
+    `flask init-db` creates an empty register index, so it is only used
+    once charities have been loaded. The answer is kept for
+    `REGISTER_CHECK_TTL` seconds so each search doesn't need extra
+    requests to elasticsearch.
+    """
+    checked = current_app.extensions.get("charity_register")
+    if checked and checked["expires"] > time.monotonic():
+        return checked["loaded"]
+    es = get_db()
+    loaded = bool(es.indices.exists(index=index) and es.count(index=index).get("count"))
+    current_app.extensions["charity_register"] = {
+        "loaded": loaded,
+        "expires": time.monotonic() + REGISTER_CHECK_TTL,
+    }
+    return loaded
+
+
+def search_charitybase(q, limit=20, skip=0):
+    from graphqlclient import GraphQLClient
+
     client = GraphQLClient(current_app.config.get("CHARITYBASE_API_URL"))
     client.inject_token("Apikey " + current_app.config.get("CHARITYBASE_API_KEY"))
     query = """
@@ -89,29 +164,113 @@ def charity_search():
     )
 
 
+@bp.route("/typeahead")
+def charity_typeahead():
+    """
+    Suggest charities as a name is typed, using only the local register
+    """
+    from elasticsearch import TransportError
+
+    q = request.values.get("q", "")
+    if len(q.strip()) < 2:
+        return jsonify({"data": [], "errors": []})
+    try:
+        results = search_register(
+            get_cached_db(), current_app.config.get("ES_CHARITY_INDEX"), q, limit=10
+        )
+    except TransportError as err:
+        logging.exception("Could not search the local charity register")
+        return jsonify({"data": [], "errors": [str(err)]})
+    return jsonify(
+        {
+            "data": [
+                {
+                    "regno": r["id"],
+                    "name": r["names"][0]["value"],
+                    "url": url_for("charity.charity_get", regno=r["id"]),
+                }
+                for r in results["results"]
+            ],
+            "errors": [],
+        }
+    )
+
+
+def fetch_concurrently(tasks: dict, timeouts: dict, default_timeout: float = 10):
+    """
+    Run each of `tasks` in the shared thread pool, each with its own timeout
+
+    Returns a dict of the results of the tasks that finished, and a dict
+    of error messages for those that failed or ran out of time.
+    """
+    app = current_app._get_current_object()
+
+    def run_in_context(func):
+        with app.app_context():
+            return func()
+
+    start = time.monotonic()
+    futures = {
+        name: executor.submit(run_in_context, func) for name, func in tasks.items()
+    }
+    results = {}
+    errors = {}
+    for name, future in futures.items():
+        deadline = start + timeouts.get(name, default_timeout)
+        try:
+            results[name] = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            # the task carries on in the background but we don't wait for it
+            logging.warning("Timed out fetching {}".format(name))
+            errors[name] = "Timed out fetching {}".format(name)
+        except Exception as err:
+            logging.exception("Error fetching {}".format(name))
+            errors[name] = "Error fetching {}: {}".format(name, err)
+    return results, errors
+
+
 @bp.route("/<regno>")
 @bp.route("/<regno>.<filetype>")
 def charity_get(regno, filetype="html"):
     es = get_db()
-    documents = es.search(
-        index=current_app.config.get("ES_INDEX"),
-        doc_type="_doc",
-        _source_includes=["regno", "fye"],
-        body={"query": {"term": {"regno": regno}}},
+    source = get_charity_type(regno)
+
+    results, errors = fetch_concurrently(
+        {
+            "documents": lambda: es.search(
+                index=current_app.config.get("ES_INDEX"),
+                doc_type="_doc",
+                _source_includes=["regno", "fye"],
+                body={"query": {"term": {"regno": regno}}},
+            ),
+            "accounts": lambda: source.list_accounts(regno),
+            "charity": lambda: source.get_charity(regno),
+        },
+        current_app.config.get("CHARITY_FETCH_TIMEOUTS", {}),
     )
+
     documents = {
         d["_source"]["fye"][0:10]: {
             "doc_id": d.get("_id"),
             "doc_url": url_for("doc.doc_get", id=d.get("_id")),
         }
-        for d in documents.get("hits", {}).get("hits", [])
+        for d in results.get("documents", {}).get("hits", {}).get("hits", [])
         if d.get("_source", {}).get("fye")
     }
 
-    source = get_charity_type(regno)
-    accounts = source.list_accounts(regno)
-    accounts = {"{:%Y-%m-%d}".format(a.fyend): a for a in accounts}
-    charity = source.get_charity(regno)
+    accounts = {"{:%Y-%m-%d}".format(a.fyend): a for a in results.get("accounts", [])}
+    if "charity" in errors:
+        # still show the accounts that were found if the charity details
+        # couldn't be fetched
+        charity = {
+            "name": regno,
+            "finances": [
+                {"financialYear": {"end": fyend}, "income": None, "spending": None}
+                for fyend in accounts
+            ],
+        }
+    else:
+        charity = results.get("charity")
     if not charity:
         abort(404)
     charity["finances"] = [
@@ -119,7 +278,7 @@ def charity_get(regno, filetype="html"):
             **f,
             **accounts.get(
                 f["financialYear"]["end"][0:10],
-                Account(None, regno, f["financialYear"]["end"][0:10]),
+                Account(None, f["financialYear"]["end"][0:10], regno),
             )._asdict(),
             **documents.get(f["financialYear"]["end"][0:10], {}),
             "fyend": f["financialYear"]["end"][0:10],
@@ -129,8 +288,50 @@ def charity_get(regno, filetype="html"):
     if filetype == "json":
         return {
             "data": dict(results=accounts, charity=charity, regno=regno),
-            "errors": [],
+            "errors": list(errors.values()),
         }
+    for error in errors.values():
+        flash(error, "error")
     return render_template(
         "charity.html.j2", results=accounts, charity=charity, regno=regno
     )
+
+
+@bp.cli.command("load-register")
+@click.argument("input_path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--delete-old/--keep-old",
+    default=True,
+    help="Delete the previous copy of the register once the new one is loaded",
+)
+@click.option(
+    "--replace-index",
+    is_flag=True,
+    help="Delete an index with the same name as the alias, so the alias can be created",
+)
+@push_metrics_after
+def cli_load_register(input_path, delete_old, replace_index):
+    """Load a charity register extract (CSV, JSON or JSON lines) for searching."""
+    es = get_db()
+    alias = current_app.config["ES_CHARITY_INDEX"]
+    try:
+        # check before loading that the alias can be moved afterwards
+        get_alias_indexes(alias, replace_index=replace_index)
+    except ReindexError as err:
+        raise click.ClickException(str(err))
+    charities = get_charities(read_register(input_path))
+    click.echo(f"Loading {len(charities)} charities")
+
+    # load into a new index so searches use the old one until it's ready
+    index = get_index_name(alias)
+    es.indices.create(index=index, body=INDEXES["ES_CHARITY_INDEX"])
+    errors = 0
+    with bulk_load_settings(index):
+        for ok, item in tqdm(load_register(es, index, charities), total=len(charities)):
+            if not ok:
+                errors += 1
+                logging.warning("Could not load charity: {}".format(item))
+    swap_alias(alias, index, delete_old=delete_old, replace_index=replace_index)
+    current_app.extensions.pop("charity_register", None)
+    clear_query_cache()
+    click.echo(f"Loaded {len(charities) - errors} charities into {alias}")
@@ -1,6 +1,6 @@
 import base64
-import csv
 import datetime
+import hashlib
 import io
 import os
 import re
@@ -9,42 +9,123 @@ from pathlib import Path
 
 import click
 import requests
-import requests_cache
-from elasticsearch import NotFoundError
-from elasticsearch.helpers import scan
 from flask import (
     Blueprint,
     Markup,
-    Response,
     abort,
     current_app,
     flash,
     jsonify,
-    make_response,
     redirect,
     render_template,
     request,
+    send_file,
     url_for,
 )
-from slugify import slugify
 from tqdm import tqdm
 from werkzeug.utils import secure_filename
 
 from docdisplay.auth import basic_auth
-from docdisplay.db import get_db
-from docdisplay.upload import convert_file, upload_doc
-from docdisplay.utils import get_nav
-
-requests_cache.install_cache("demo_cache")
+from docdisplay.blobstore import BlobNotFoundError, get_blob_store
+from docdisplay.db import bulk_load_settings, get_cached_db, get_db, search_page
+from docdisplay.export import (
+    EXPORT_FORMATS,
+    ExportError,
+    export_response,
+    get_export_fields,
+    get_rows,
+)
+from docdisplay.http_cache import get_session
+from docdisplay.metrics import push_metrics_after
+from docdisplay.query_cache import clear_query_cache
+from docdisplay.upload import (
+    BULK_CHUNK_SIZE,
+    BULK_MAX_CHUNK_BYTES,
+    bulk_upload,
+    check_existing,
+    convert_file,
+    get_doc_id,
+    get_page_actions,
+    get_page_docs,
+    get_page_id,
+    split_pages,
+    upload_doc,
+)
+from docdisplay.utils import decode_cursor, get_nav
 
 CC_ACCOUNT_FILENAME = r"([0-9]+)_AC_([0-9]{4})([0-9]{2})([0-9]{2})_E_C.PDF"
 
 bp = Blueprint("doc", __name__, url_prefix="/doc")
 
 
+HIGHLIGHT_CLASS = 'data-charity-account-highlight="true"'
+
+
+def get_highlight(field, q):
+    return {
+        "fields": {
+            field: {
+                "number_of_fragments": 0,
+                "pre_tags": [f'<em class="bg-yellow b highlight" {HIGHLIGHT_CLASS}>'],
+                "post_tags": ["</em>"],
+                "highlight_query": {
+                    "simple_query_string": {
+                        "query": q,
+                        "fields": [field],
+                        "default_operator": "or",
+                    }
+                },
+            }
+        },
+        "encoder": "html",
+    }
+
+
+def get_doc_pages(es, doc, q):
+    """
+    Find the pages of a document that match the search and highlight them
+
+    Only the matching pages are fetched. They are stored in the document
+    as a dict of `{page number: highlighted content}`.
+    """
+    page_count = doc["_source"].get("attachment", {}).get("pages") or 0
+    search_pages = es.search(
+        index=current_app.config.get("ES_PAGES_INDEX"),
+        doc_type="_doc",
+        _source_includes=["page"],
+        body={
+            "size": page_count,
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"doc_id": doc["_id"]}}],
+                    "must": [
+                        {
+                            "simple_query_string": {
+                                "query": q,
+                                "fields": ["content"],
+                                "default_operator": "or",
+                            }
+                        }
+                    ],
+                }
+            },
+            "sort": [{"page": "asc"}],
+            "highlight": get_highlight("content", q),
+        },
+    )
+    pages = {}
+    for page in search_pages.get("hits", {}).get("hits", []):
+        if page.get("highlight", {}).get("content"):
+            pages[page["_source"]["page"]] = Markup(
+                page["highlight"]["content"][0]
+            ).unescape()
+    doc["_highlight_pages"] = pages
+    doc["_highlight_count"] = sum(c.count(HIGHLIGHT_CLASS) for c in pages.values())
+    return doc
+
+
 def get_doc(id, q=None):
-    highlight_class = 'data-charity-account-highlight="true"'
-    es = get_db()
+    es = get_cached_db()
     body = {
         "query": {
             "terms": {
@@ -53,26 +134,22 @@ def get_doc(id, q=None):
         }
     }
     if q:
-        body["highlight"] = {
-            "fields": {
-                "attachment.content": {
-                    "number_of_fragments": 0,
-                    "pre_tags": [
-                        f'<em class="bg-yellow b highlight" {highlight_class}>'
-                    ],
-                    "post_tags": ["</em>"],
-                    "highlight_query": {
-                        "simple_query_string": {
-                            "query": q,
-                            "fields": ["attachment.content"],
-                            "default_operator": "or",
-                        }
-                    },
-                }
-            },
-            "encoder": "html",
-        }
-    search_doc = es.search(
+        # documents with their pages indexed separately only need the
+        # matching pages, rather than the whole content
+        search_doc = es.search(
+            index=current_app.config.get("ES_INDEX"),
+            doc_type="_doc",
+            body=body,
+            _source_excludes=["filedata", "attachment.content"],
+        )
+        docs = search_doc.get("hits", {}).get("hits", [])
+        if not docs:
+            return None
+        if docs[0]["_source"].get("pages_indexed"):
+            return get_doc_pages(es, docs[0], q)
+        body["highlight"] = get_highlight("attachment.content", q)
+    # the whole text of a document can be several MB, so this isn't cached
+    search_doc = get_db().search(
         index=current_app.config.get("ES_INDEX"),
         doc_type="_doc",
         body=body,
@@ -83,31 +160,60 @@ def get_doc(id, q=None):
         if doc.get("highlight", {}).get("attachment.content"):
             content = doc["highlight"]["attachment.content"][0]
             content = Markup(content).unescape()
-            doc["_highlight_count"] = content.count(highlight_class)
+            doc["_highlight_count"] = content.count(HIGHLIGHT_CLASS)
             doc["_source"]["attachment"]["content"] = content
         return doc
 
 
 @bp.route("/<id>.pdf")
 def doc_get_pdf(id):
+    """
+    Send the PDF for a document
+
+    Responses have a strong ETag (the SHA-256 hash of the file) so they
+    can be revalidated, and support Range requests.
+    """
+    from elasticsearch import NotFoundError
+
     es = get_db()
     try:
         doc = es.get(
             index=current_app.config.get("ES_INDEX"),
             doc_type="_doc",
             id=id,
-            _source_includes=["filedata"],
+            _source_includes=["filehash", "filedata", "attachment.date"],
         )
     except NotFoundError:
         abort(404, description=f"Could not find document (id: [{id}])")
-    return make_response(
-        base64.b64decode(doc.get("_source", {}).get("filedata")),
-        200,
-        {
-            "Content-type": "application/pdf",
-            # "Content-Disposition": "attachment;filename={}.pdf".format(id)
-        },
+    source = doc.get("_source", {})
+    last_modified = source.get("attachment", {}).get("date")
+    if last_modified:
+        last_modified = datetime.datetime.fromisoformat(last_modified)
+
+    if source.get("filehash"):
+        blob_store = get_blob_store()
+        etag = source["filehash"]
+        try:
+            file = blob_store.get_path(etag) or io.BytesIO(blob_store.get(etag))
+        except BlobNotFoundError:
+            abort(404, description=f"Could not find file for document (id: [{id}])")
+    else:
+        content = base64.b64decode(source.get("filedata"))
+        etag = hashlib.sha256(content).hexdigest()
+        file = io.BytesIO(content)
+
+    response = send_file(
+        file,
+        mimetype="application/pdf",
+        download_name=f"{id}.pdf",
+        conditional=True,
+        etag=etag,
+        last_modified=last_modified,
     )
+    # werkzeug only adds this to 206 responses, but PDF viewers look for it
+    # on the first response before they'll request ranges
+    response.headers["Accept-Ranges"] = "bytes"
+    return response
 
 
 @bp.route("/<id>")
@@ -122,6 +228,7 @@ def doc_get(id):
         id=id,
         highlight=highlight,
         highlight_count=doc.get("_highlight_count", 0),
+        highlight_pages=list(doc.get("_highlight_pages", {})),
     )
 
 
@@ -131,27 +238,63 @@ def doc_get_embed(id):
     doc = get_doc(id, highlight)
     if not doc:
         abort(404, description=f"Could not find document (id: [{id}])")
-    content = doc.get("_source", {}).get("attachment", {}).get("content", "")
+    attachment = doc.get("_source", {}).get("attachment", {})
     return render_template(
         "doc_display_embed.html.j2",
-        content=content,
+        content=attachment.get("content", ""),
+        pages=doc.get("_highlight_pages"),
+        page_count=attachment.get("pages"),
         id=id,
         highlight=highlight,
     )
 
 
+@bp.route("/<id>/page/<int:page>")
+def doc_get_page(id, page):
+    """
+    Get the text of one page of a document, so the viewer can load it on demand
+    """
+    from elasticsearch import NotFoundError
+
+    es = get_db()
+    try:
+        page_doc = es.get(
+            index=current_app.config.get("ES_PAGES_INDEX"),
+            doc_type="_doc",
+            id=get_page_id(id, page),
+            _source_includes=["content"],
+        )
+    except NotFoundError:
+        return (
+            jsonify(
+                {
+                    "data": {},
+                    "errors": [f"Could not find page {page} of document {id}"],
+                }
+            ),
+            404,
+        )
+    return jsonify(
+        {
+            "data": {
+                "id": id,
+                "page": page,
+                "content": page_doc["_source"]["content"],
+            },
+            "errors": [],
+        }
+    )
+
+
 @bp.route("/search")
 @bp.route("/search.<filetype>")
 def doc_search(filetype="html"):
+    from slugify import slugify
+
     es = get_db()
     q = request.values.get("q")
-
-    try:
-        p = int(request.values.get("p", 1))
-    except ValueError:
-        p = 1
+    cursor = decode_cursor(request.values.get("cursor"))
     limit = 10
-    skip = limit * (p - 1)
 
     results = None
     resultCount = 0
@@ -171,38 +314,26 @@ def doc_search(filetype="html"):
                 }
             },
         )
-        if filetype == "csv":
-            params["query"] = params.pop("body")
-            doc = scan(
+        if filetype in EXPORT_FORMATS:
+            try:
+                fields = get_export_fields(request.values.get("fields"))
+            except ExportError as err:
+                abort(400, description=str(err))
+            rows = get_rows(
                 es,
+                fields + ["search term"],
+                extra={"search term": q},
+                index=params["index"],
+                doc_type=params["doc_type"],
+                query=params["body"],
                 request_timeout=10000,
-                **params,
             )
-            buffer = io.StringIO()
-            fields = [
-                "regno",
-                "fye",
-                "filename",
-                "name",
-                "income",
-                "spending",
-                "assets",
-                "search term",
-            ]
-            writer = csv.DictWriter(buffer, fieldnames=fields)
-            writer.writeheader()
-            for k, result in enumerate(doc):
-                row = {
-                    "search term": q,
-                    **{k: v for k, v in result["_source"].items() if k in fields},
-                }
-                writer.writerow(row)
-            output = make_response(buffer.getvalue())
-            output.headers[
-                "Content-Disposition"
-            ] = f"attachment; filename=account_search_{slugify(q, separator='_')}.csv"
-            output.headers["Content-type"] = "text/csv"
-            return output
+            return export_response(
+                rows,
+                fields + ["search term"],
+                filetype,
+                f"account_search_{slugify(q, separator='_')}",
+            )
         params["body"]["highlight"] = {
             "fields": {
                 "attachment.content": {
@@ -214,23 +345,21 @@ def doc_search(filetype="html"):
             },
             "encoder": "html",
         }
-        doc = es.search(
+        p, results, resultCount = search_page(
+            get_cached_db(),
+            sort=[{"_score": "desc"}, {"_id": "asc"}],
+            limit=limit,
+            cursor=cursor,
             **params,
-            from_=skip,
-            size=limit,
         )
-        resultCount = doc.get("hits", {}).get("total", 0)
-        if isinstance(resultCount, dict):
-            resultCount = resultCount.get("value")
-
         nav = get_nav(
             p,
             limit,
             resultCount,
             "doc.doc_search",
             dict(q=q),
+            results=results,
         )
-        results = doc.get("hits", {}).get("hits", [])
         for r in results:
             if r.get("highlight", {}).get("attachment.content"):
                 r["highlight"]["attachment.content"] = [
@@ -243,6 +372,7 @@ def doc_search(filetype="html"):
         resultCount=resultCount,
         nav=nav,
         downloadUrl=url_for("doc.doc_search", q=q, filetype="csv"),
+        downloadJsonUrl=url_for("doc.doc_search", q=q, filetype="jsonl"),
     )
 
 
@@ -257,81 +387,52 @@ def doc_upload_bulk():
 @basic_auth.required
 def doc_all_docs(filetype="html"):
     es = get_db()
-
-    try:
-        p = int(request.values.get("p", 1))
-    except ValueError:
-        p = 1
+    cursor = decode_cursor(request.values.get("cursor"))
     limit = 10
-    skip = limit * (p - 1)
 
     results = None
     resultCount = 0
     nav = {}
 
-    if filetype == "csv":
-        doc = scan(
+    if filetype in EXPORT_FORMATS:
+        try:
+            fields = get_export_fields(request.values.get("fields"))
+        except ExportError as err:
+            abort(400, description=str(err))
+        rows = get_rows(
             es,
+            fields,
             index=current_app.config.get("ES_INDEX"),
             doc_type="_doc",
-            _source_excludes=["filedata", "attachment"],
             request_timeout=1000,
         )
-        fields = [
-            "regno",
-            "fye",
-            "filename",
-            "name",
-            "income",
-            "spending",
-            "assets",
-        ]
-
-        def generate_csv():
-            buffer = io.StringIO()
-            writer = csv.DictWriter(buffer, fieldnames=fields)
-            writer.writeheader()
-            yield buffer.getvalue()
-
-            for result in doc:
-                buffer = io.StringIO()
-                writer = csv.DictWriter(buffer, fieldnames=fields)
-                writer.writerow(result["_source"])
-                yield buffer.getvalue()
-
-        return Response(
-            generate_csv(),
-            mimetype="text/csv",
-            headers={
-                "Content-Disposition": "attachment; filename=all_accounts.csv",
-                "Content-type": "text/csv",
-            },
-        )
-
-    res = es.search(
+        return export_response(rows, fields, filetype, "all_accounts")
+
+    p, results, resultCount = search_page(
+        get_cached_db(),
+        body={"query": {"match_all": {}}},
+        sort=[{"fye": "desc"}, {"_id": "asc"}],
+        limit=limit,
+        cursor=cursor,
         index=current_app.config.get("ES_INDEX"),
         doc_type="_doc",
         _source_excludes=["filedata", "attachment"],
-        body={"size": limit, "from": skip, "query": {"match_all": {}}},
     )
-    resultCount = res.get("hits", {}).get("total", 0)
-    if isinstance(resultCount, dict):
-        resultCount = resultCount.get("value")
-
     nav = get_nav(
         p,
         limit,
         resultCount,
         "doc.doc_all_docs",
         dict(),
+        results=results,
     )
-    results = res.get("hits", {}).get("hits", [])
     return render_template(
         "doc_all_docs.html.j2",
         results=results,
         resultCount=resultCount,
         nav=nav,
         downloadUrl=url_for("doc.doc_all_docs", filetype="csv"),
+        downloadJsonUrl=url_for("doc.doc_all_docs", filetype="jsonl"),
     )
 
 
@@ -358,7 +459,7 @@ def doc_upload(filetype="html"):
         # download from an URL
         elif url:
 
-            r = requests.get(url)
+            r = get_session("pdf").get(url)
             if not r.status_code == requests.codes.ok:
                 flash("Couldn't load from URL: {}".format(url), "error")
                 if filetype == "json":
@@ -456,7 +557,39 @@ def doc_upload(filetype="html"):
 )
 @click.option("--debug/--no-debug", default=False)
 @click.option("--skip-if-exists/--no-skip-if-exists", default=False)
-def cli_upload(input_path, debug, skip_if_exists=False):
+@click.option(
+    "--bulk/--no-bulk",
+    default=False,
+    help="Send documents to elasticsearch in bulk requests",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of processes used to extract text when using --bulk",
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=BULK_CHUNK_SIZE,
+    help="Maximum number of documents in each bulk request",
+)
+@click.option(
+    "--max-chunk-bytes",
+    type=int,
+    default=BULK_MAX_CHUNK_BYTES,
+    help="Maximum size in bytes of each bulk request",
+)
+@push_metrics_after
+def cli_upload(
+    input_path,
+    debug,
+    skip_if_exists=False,
+    bulk=False,
+    workers=1,
+    chunk_size=BULK_CHUNK_SIZE,
+    max_chunk_bytes=BULK_MAX_CHUNK_BYTES,
+):
     def file_generator(directory):
         pathlist = Path(directory).glob("**/*.pdf")
         for filename in pathlist:
@@ -467,20 +600,20 @@ def cli_upload(input_path, debug, skip_if_exists=False):
     else:
         files = [input_path]
 
-    for filepath in tqdm(files):
-        filesize = os.path.getsize(filepath)
-        if filesize > current_app.config["FILE_SIZE_LIMT"]:
-            click.echo(
-                click.style(
-                    f"ERROR Filesize too big: {filepath} [{filesize}]",
-                    fg="white",
-                    bg="red",
-                ),
-                err=True,
-            )
-            continue
+    def get_charities(files):
+        for filepath in tqdm(files):
+            filesize = os.path.getsize(filepath)
+            if filesize > current_app.config["FILE_SIZE_LIMT"]:
+                click.echo(
+                    click.style(
+                        f"ERROR Filesize too big: {filepath} [{filesize}]",
+                        fg="white",
+                        bg="red",
+                    ),
+                    err=True,
+                )
+                continue
 
-        with open(filepath, "rb") as pdffile:
             filename = os.path.basename(filepath)
             regno, fyend = filename.rstrip(".pdf").split("_")
             fyend = datetime.date(
@@ -488,7 +621,7 @@ def cli_upload(input_path, debug, skip_if_exists=False):
                 int(fyend[4:6]),
                 int(fyend[6:8]),
             )
-            charity = {
+            yield filepath, {
                 "regno": regno,
                 "fye": fyend,
                 # "name": request.values.get("name"),
@@ -496,28 +629,195 @@ def cli_upload(input_path, debug, skip_if_exists=False):
                 # "spending": request.values.get("spending"),
                 # "assets": request.values.get("assets"),
             }
+
+    def echo_result(filepath, result):
+        if result["result"] in ("created", "updated", "already exists"):
+            if debug:
+                click.echo(
+                    click.style(f"Document {result['result']}: {filepath}", fg="green")
+                )
+        else:
+            click.echo(
+                click.style(
+                    f"ERROR Could not upload document: {filepath}",
+                    fg="white",
+                    bg="red",
+                ),
+                err=True,
+            )
+            print(result)
+
+    es = get_db()
+    index = current_app.config["ES_INDEX"]
+    pages_index = current_app.config["ES_PAGES_INDEX"]
+    charities = get_charities(files)
+    if skip_if_exists:
+
+        def skip_existing(charities):
+            for filepath, charity, exists in check_existing(es, index, charities):
+                if not exists:
+                    yield filepath, charity
+                    continue
+                echo_result(
+                    filepath,
+                    {
+                        "_index": index,
+                        "_type": "_doc",
+                        "_id": get_doc_id(charity),
+                        "result": "already exists",
+                    },
+                )
+
+        charities = skip_existing(charities)
+
+    if bulk:
+        with bulk_load_settings(index), bulk_load_settings(pages_index):
+            for filepath, result in bulk_upload(
+                es,
+                index,
+                charities,
+                pages_index=pages_index,
+                workers=workers,
+                chunk_size=chunk_size,
+                max_chunk_bytes=max_chunk_bytes,
+                blob_store=get_blob_store(),
+            ):
+                echo_result(filepath, result)
+        clear_query_cache()
+        return
+
+    for filepath, charity in charities:
+        with open(filepath, "rb") as pdffile:
             if debug:
                 click.echo(f"Uploading document: {pdffile.name}")
-            result = upload_doc(
-                charity, pdffile.read(), get_db(), skip_if_exists=skip_if_exists
+            result = upload_doc(charity, pdffile.read(), es)
+            echo_result(pdffile.name, result)
+
+
+@bp.cli.command("migrate-files")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=20,
+    help="Number of documents to fetch from elasticsearch at once",
+)
+@push_metrics_after
+def cli_migrate_files(batch_size):
+    """Move PDF files stored in elasticsearch into the blob store."""
+    from elasticsearch.helpers import scan, streaming_bulk
+
+    blob_store = get_blob_store()
+    if not blob_store:
+        raise click.UsageError("No BLOB_STORE is configured")
+    es = get_db()
+
+    def generate_actions():
+        docs = scan(
+            es,
+            index=current_app.config["ES_INDEX"],
+            doc_type="_doc",
+            query={"query": {"exists": {"field": "filedata"}}},
+            _source_includes=["filedata"],
+            size=batch_size,
+        )
+        for doc in docs:
+            content = base64.b64decode(doc["_source"]["filedata"])
+            yield {
+                "_op_type": "update",
+                "_index": doc["_index"],
+                "_type": doc["_type"],
+                "_id": doc["_id"],
+                "script": {
+                    "source": (
+                        "ctx._source.filehash = params.filehash;"
+                        "ctx._source.filesize = params.filesize;"
+                        "ctx._source.remove('filedata');"
+                    ),
+                    "params": {
+                        "filehash": blob_store.put(content),
+                        "filesize": len(content),
+                    },
+                },
+            }
+
+    migrated = 0
+    for ok, item in tqdm(
+        streaming_bulk(
+            es, generate_actions(), chunk_size=batch_size, raise_on_error=False
+        )
+    ):
+        if ok:
+            migrated += 1
+        else:
+            click.echo(
+                click.style(
+                    f"ERROR Could not migrate document: {item}", fg="white", bg="red"
+                ),
+                err=True,
             )
-            if result["result"] in ("created", "updated", "already exists"):
-                if debug:
-                    click.echo(
-                        click.style(
-                            f"Document {result['result']}: {pdffile.name}", fg="green"
-                        )
-                    )
-            else:
+    clear_query_cache()
+    click.echo(f"Moved {migrated} files to the blob store")
+
+
+@bp.cli.command("index-pages")
+@click.option(
+    "--batch-size",
+    type=int,
+    default=20,
+    help="Number of documents to fetch from elasticsearch at once",
+)
+@push_metrics_after
+def cli_index_pages(batch_size):
+    """Index the pages of documents uploaded before pages were indexed."""
+    from elasticsearch.helpers import scan, streaming_bulk
+
+    es = get_db()
+    pages_index = current_app.config["ES_PAGES_INDEX"]
+
+    def generate_actions():
+        docs = scan(
+            es,
+            index=current_app.config["ES_INDEX"],
+            doc_type="_doc",
+            query={
+                "query": {"bool": {"must_not": [{"term": {"pages_indexed": True}}]}}
+            },
+            _source_includes=["regno", "fye", "attachment.content"],
+            size=batch_size,
+        )
+        for doc in docs:
+            source = doc["_source"]
+            pages = split_pages(source.get("attachment", {}).get("content", ""))
+            yield from get_page_actions(
+                pages_index, get_page_docs(doc["_id"], source, pages)
+            )
+            yield {
+                "_op_type": "update",
+                "_index": doc["_index"],
+                "_type": doc["_type"],
+                "_id": doc["_id"],
+                "doc": {"pages_indexed": True},
+            }
+
+    indexed = 0
+    with bulk_load_settings(pages_index):
+        for ok, item in tqdm(
+            streaming_bulk(
+                es, generate_actions(), chunk_size=batch_size, raise_on_error=False
+            )
+        ):
+            op_type, info = item.popitem()
+            if not ok:
                 click.echo(
                     click.style(
-                        f"ERROR Could not upload document: {pdffile.name}",
-                        fg="white",
-                        bg="red",
+                        f"ERROR Could not index pages: {info}", fg="white", bg="red"
                     ),
                     err=True,
                 )
-                print(result)
+            elif op_type == "update":
+                indexed += 1
+    clear_query_cache()
+    click.echo(f"Indexed the pages of {indexed} documents")
 
 
 @bp.cli.command("check_pdf")
@@ -1,6 +1,9 @@
-from flask import Blueprint, current_app, render_template
+from flask import Blueprint, current_app, jsonify, render_template
 
-from docdisplay.db import get_db
+from docdisplay.auth import basic_auth
+from docdisplay.db import get_cached_db, get_pool_stats
+from docdisplay.metrics import metrics_response
+from docdisplay.query_cache import get_query_cache
 
 CC_ACCOUNT_FILENAME = r"([0-9]+)_AC_([0-9]{4})([0-9]{2})([0-9]{2})_E_C.PDF"
 
@@ -9,10 +12,29 @@ bp = Blueprint("main", __name__, url_prefix="/")
 
 @bp.route("/")
 def index():
-    es = get_db()
+    es = get_cached_db()
     count = es.count(
         index=current_app.config.get("ES_INDEX"),
         doc_type="_doc",
         body={"query": {"match_all": {}}},
     )
     return render_template("index.html.j2", docs=count.get("count", 0))
+
+
+@bp.route("/cache.json")
+@basic_auth.required
+def cache_stats():
+    cache = get_query_cache()
+    return jsonify({"data": cache.stats() if cache else None, "errors": []})
+
+
+@bp.route("/es.json")
+@basic_auth.required
+def elasticsearch_stats():
+    return jsonify({"data": get_pool_stats(), "errors": []})
+
+
+@bp.route("/metrics")
+@basic_auth.required
+def metrics():
+    return metrics_response()
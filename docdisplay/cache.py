@@ -0,0 +1,173 @@
+import json
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+
+from docdisplay.utils import parse_datetime
+
+_create_lock = threading.Lock()
+
+
+class SQLiteStore:
+    """
+    Base class for data kept in an SQLite database between runs
+
+    Subclasses set `schema` to the SQL needed to create their table. The
+    connection can be shared between threads.
+    """
+
+    schema = None
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(self.schema)
+
+
+class ListingCache(SQLiteStore):
+    """
+    Persistent cache of the accounts each regulator lists for a charity
+
+    The parsed accounts are stored keyed by the regulator and the charity
+    number. Entries older than `ttl` seconds are ignored. A charity with no
+    accounts may just not have been published yet, so empty lists are only
+    kept for `empty_ttl` seconds.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS listings (
+            regulator TEXT NOT NULL,
+            regno TEXT NOT NULL,
+            accounts TEXT NOT NULL,
+            fetched REAL NOT NULL,
+            PRIMARY KEY (regulator, regno)
+        )
+    """
+
+    def __init__(self, path: str, ttl: int = 60 * 60 * 24, empty_ttl: int = 60 * 15):
+        super().__init__(path)
+        self.ttl = ttl
+        self.empty_ttl = empty_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, regulator: str, regno: str) -> list:
+        """
+        Get the cached accounts, or None if they aren't cached or have expired
+
+        Accounts are returned as dicts with the `fyend` parsed as a date.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT accounts, fetched FROM listings "
+                "WHERE regulator = ? AND regno = ?",
+                (regulator, regno),
+            ).fetchone()
+            accounts = json.loads(row[0]) if row else None
+            ttl = self.ttl if accounts else self.empty_ttl
+            if accounts is None or (ttl and row[1] < time.time() - ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+        return [{**a, "fyend": parse_datetime(a["fyend"])} for a in accounts]
+
+    def set(self, regulator: str, regno: str, accounts: list):
+        accounts = json.dumps(
+            [{**a._asdict(), "fyend": a.fyend.isoformat()} for a in accounts]
+        )
+        with self._lock:
+            self._conn.execute(
+                "REPLACE INTO listings (regulator, regno, accounts, fetched) "
+                "VALUES (?, ?, ?, ?)",
+                (regulator, regno, accounts, time.time()),
+            )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+class OrganisationNumberMap(SQLiteStore):
+    """
+    Persistent map of CCEW registered numbers to organisation numbers
+
+    Organisation numbers don't change, so entries don't expire.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS organisation_numbers (
+            regno TEXT NOT NULL PRIMARY KEY,
+            organisation_number INTEGER NOT NULL
+        )
+    """
+
+    def get(self, regno: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT organisation_number FROM organisation_numbers WHERE regno = ?",
+                (regno,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def update(self, organisation_numbers: dict):
+        with self._lock:
+            self._conn.executemany(
+                "REPLACE INTO organisation_numbers (regno, organisation_number) "
+                "VALUES (?, ?)",
+                organisation_numbers.items(),
+            )
+
+    def missing(self, regnos: list) -> list:
+        """
+        Find which of `regnos` aren't in the map yet
+        """
+        regnos = list(dict.fromkeys(regnos))
+        found = set()
+        with self._lock:
+            # stay well below SQLite's limit on the number of parameters
+            for i in range(0, len(regnos), 500):
+                batch = regnos[i : i + 500]
+                sql = "SELECT regno FROM organisation_numbers WHERE regno IN ({})"
+                rows = self._conn.execute(sql.format(",".join("?" * len(batch))), batch)
+                found.update(row[0] for row in rows)
+        return [regno for regno in regnos if regno not in found]
+
+
+def _get_store(name, store_class, **kwargs):
+    if not current_app.config.get("LISTING_CACHE_PATH"):
+        return None
+    with _create_lock:
+        if name not in current_app.extensions:
+            current_app.extensions[name] = store_class(
+                current_app.config["LISTING_CACHE_PATH"], **kwargs
+            )
+    return current_app.extensions[name]
+
+
+def get_listing_cache():
+    """
+    Get the listing cache for this process, if one is configured
+    """
+    return _get_store(
+        "listing_cache",
+        ListingCache,
+        ttl=current_app.config.get("LISTING_CACHE_TTL"),
+        empty_ttl=current_app.config.get("LISTING_CACHE_EMPTY_TTL"),
+    )
+
+
+def get_organisation_numbers():
+    """
+    Get the map of CCEW organisation numbers, stored alongside the listing cache
+    """
+    return _get_store("organisation_numbers", OrganisationNumberMap)
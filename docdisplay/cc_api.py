@@ -2,6 +2,8 @@ import types
 
 from requests import Session
 
+from docdisplay.throttle import HostLimiter
+
 ENDPOINTS = {
     "SectorDataIncomeCategory": "/sectorincomecategory",
     "SectorDataOverview": "/sectoroverview",
@@ -46,9 +48,21 @@ class CharityCommissionAPI:
 
     base_url = "https://api.charitycommission.gov.uk/register/api"
 
-    def __init__(self, authentication_key, session=None):
+    def __init__(
+        self,
+        authentication_key,
+        session=None,
+        limiter=None,
+        refresh=False,
+        timeout=None,
+    ):
         self.auth_key = authentication_key
+        # cached responses are only skipped when refreshing, so the
+        # session's HTTP cache can answer repeated requests
+        self.refresh = refresh
+        self.timeout = timeout
         self.session = session if session else Session()
+        self.limiter = limiter if limiter else HostLimiter()
 
         for name, path in ENDPOINTS.items():
             self._add_endpoint_function(name, path)
@@ -64,17 +78,23 @@ class CharityCommissionAPI:
         setattr(self, name, meth)
 
     def _auth_headers(self):
-        return {
-            "Cache-Control": "no-cache",
-            "Ocp-Apim-Subscription-Key": self.auth_key,
-        }
+        headers = {"Ocp-Apim-Subscription-Key": self.auth_key}
+        if self.refresh:
+            headers["Cache-Control"] = "no-cache"
+        return headers
 
     def _get_request(self, url):
-        r = self.session.get(url, headers=self._auth_headers())
+        with self.limiter.slot("ccapi"):
+            r = self.session.get(
+                url, headers=self._auth_headers(), timeout=self.timeout
+            )
         r.raise_for_status()
         return r.json()
 
     def _post_request(self, url, data):
-        r = self.session.post(url, data=data, headers=self._auth_headers())
+        with self.limiter.slot("ccapi"):
+            r = self.session.post(
+                url, data=data, headers=self._auth_headers(), timeout=self.timeout
+            )
         r.raise_for_status()
         return r.json()
@@ -1,30 +1,424 @@
+import datetime
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
 import click
-import elasticsearch
-from flask import current_app, g
+from flask import current_app
 from flask.cli import with_appcontext
 
+from docdisplay.query_cache import CachedClient, clear_query_cache, get_query_cache
+
+# bump this when the mappings or settings below change, then run
+# `flask reindex` to move existing documents into new indexes
+MAPPING_VERSION = 1
+
+_create_lock = threading.Lock()
+
+DOCS_INDEX = {
+    "settings": {
+        "index": {
+            "number_of_shards": 1,
+        }
+    },
+    "mappings": {
+        "_doc": {
+            "_meta": {"version": MAPPING_VERSION},
+            "properties": {
+                "regno": {"type": "keyword"},
+                "fye": {"type": "date"},
+                "name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                "income": {"type": "long", "ignore_malformed": True},
+                "spending": {"type": "long", "ignore_malformed": True},
+                "assets": {"type": "long", "ignore_malformed": True},
+                "filename": {"type": "keyword"},
+                # PDFs stored in elasticsearch aren't searched
+                "filedata": {"type": "binary"},
+                "filehash": {"type": "keyword"},
+                "filesize": {"type": "long"},
+                "pages_indexed": {"type": "boolean"},
+                "attachment": {
+                    "properties": {
+                        # store offsets so highlighting doesn't need to
+                        # analyse the content again
+                        "content": {
+                            "type": "text",
+                            "term_vector": "with_positions_offsets",
+                        },
+                        "content_length": {"type": "long"},
+                        "pages": {"type": "integer"},
+                        "content_type": {"type": "keyword"},
+                        "language": {"type": "keyword"},
+                        "date": {"type": "date"},
+                    }
+                },
+            },
+        }
+    },
+}
+
+PAGES_INDEX = {
+    "settings": {
+        "index": {
+            "number_of_shards": 1,
+        }
+    },
+    "mappings": {
+        "_doc": {
+            "_meta": {"version": MAPPING_VERSION},
+            "properties": {
+                "doc_id": {"type": "keyword"},
+                "page": {"type": "integer"},
+                "regno": {"type": "keyword"},
+                "fye": {"type": "date"},
+                "content": {"type": "text", "term_vector": "with_positions_offsets"},
+            },
+        }
+    },
+}
+
+# names are indexed in pieces from the start of each word, so they can be
+# searched as they are typed
+NAME_FIELD = {
+    "type": "text",
+    "fields": {
+        "autocomplete": {
+            "type": "text",
+            "analyzer": "autocomplete",
+            "search_analyzer": "standard",
+        }
+    },
+}
+
+CHARITIES_INDEX = {
+    "settings": {
+        "index": {
+            "number_of_shards": 1,
+        },
+        "analysis": {
+            "filter": {
+                "autocomplete_filter": {
+                    "type": "edge_ngram",
+                    "min_gram": 2,
+                    "max_gram": 20,
+                }
+            },
+            "analyzer": {
+                "autocomplete": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "asciifolding", "autocomplete_filter"],
+                }
+            },
+        },
+    },
+    "mappings": {
+        "_doc": {
+            "_meta": {"version": MAPPING_VERSION},
+            "properties": {
+                "regno": {"type": "keyword"},
+                "name": NAME_FIELD,
+                "names": NAME_FIELD,
+                "finances": {
+                    "properties": {
+                        "fyend": {"type": "date"},
+                        "income": {"type": "long", "ignore_malformed": True},
+                        "spending": {"type": "long", "ignore_malformed": True},
+                    }
+                },
+            },
+        }
+    },
+}
+
+# the definition of the index named by each config setting
+INDEXES = {
+    "ES_INDEX": DOCS_INDEX,
+    "ES_PAGES_INDEX": PAGES_INDEX,
+    "ES_CHARITY_INDEX": CHARITIES_INDEX,
+}
+
+
+class ReindexError(Exception):
+    pass
+
 
 def get_db():
-    if "es" not in g:
-        g.es = elasticsearch.Elasticsearch(current_app.config["ES_URL"])
+    """
+    Get the elasticsearch client for this process
+
+    The client, and its pool of connections, is created the first time it
+    is needed and shared by every request. A new one is created in a
+    forked process, as connections can't be shared between processes.
+    """
+    # elasticsearch is only imported once a client is needed, so commands
+    # that don't use it start quickly
+    from docdisplay.es_client import create_client
+
+    client = current_app.extensions.get("es")
+    if client is None or client.pid != os.getpid():
+        with _create_lock:
+            client = current_app.extensions.get("es")
+            if client is None or client.pid != os.getpid():
+                client = create_client(current_app.config)
+                client.pid = os.getpid()
+                current_app.extensions["es"] = client
+    return client
+
 
-    return g.es
+def get_pool_stats() -> dict:
+    """
+    Get the connection pool stats for the elasticsearch client in this process
+    """
+    client = current_app.extensions.get("es")
+    if client is None:
+        return None
+    return {
+        **client.pool_stats.as_dict(),
+        "connections": [
+            {
+                "host": connection.host,
+                "maxsize": connection.pool.pool.maxsize,
+                "created": connection.pool.num_connections,
+                "requests": connection.pool.num_requests,
+            }
+            for connection in client.transport.connection_pool.connections
+        ],
+    }
 
 
-def close_db(e=None):
-    g.pop("es", None)
+def get_cached_db():
+    """
+    Get the elasticsearch client, with searches cached if the cache is turned on
+    """
+    cache = get_query_cache()
+    if cache is None:
+        return get_db()
+    return CachedClient(get_db(), cache)
+
+
+def get_index_name(alias: str) -> str:
+    """
+    Get a name for a new index behind an alias, including the mapping version
+    """
+    return "{}-v{}-{:%Y%m%d%H%M%S}".format(
+        alias, MAPPING_VERSION, datetime.datetime.now()
+    )
 
 
 def init_db():
     es = get_db()
-    if not es.indices.exists(index=current_app.config["ES_INDEX"]):
-        es.indices.create(index=current_app.config["ES_INDEX"])
+    for setting, definition in INDEXES.items():
+        alias = current_app.config[setting]
+        if not es.indices.exists(index=alias):
+            es.indices.create(
+                index=get_index_name(alias),
+                body={**definition, "aliases": {alias: {}}},
+            )
+
+
+def reindex(
+    alias: str,
+    definition: dict,
+    delete_old=False,
+    replace_index=False,
+    progress=None,
+    poll_interval=10,
+):
+    """
+    Copy the documents behind an alias into a new index and swap the alias
+
+    The new index is created with the current mapping and settings. The
+    alias is moved to the new index in a single atomic action once all the
+    documents have been copied, so searches keep working throughout.
+    Writes to the old indexes are blocked while the copy runs, so no
+    changes are lost - uploads fail until the alias has moved.
+
+    An index named the same as the alias (created before the mapping was
+    managed) is only replaced if `replace_index` is true.
+
+    `progress` is called with the status of the copy while it runs.
+    Returns the name of the new index.
+    """
+    es = get_db()
+    old_indexes = get_alias_indexes(alias, replace_index=replace_index)
+    new_index = get_index_name(alias)
+    es.indices.create(index=new_index, body=definition)
+    with write_block(old_indexes):
+        with bulk_load_settings(new_index):
+            task = es.reindex(
+                body={"source": {"index": alias}, "dest": {"index": new_index}},
+                wait_for_completion=False,
+            )
+            while True:
+                status = es.tasks.get(task_id=task["task"])
+                if progress:
+                    progress(status["task"]["status"])
+                if status.get("completed"):
+                    break
+                time.sleep(poll_interval)
+        failures = status.get("response", {}).get("failures") or status.get("error")
+        if failures:
+            raise ReindexError("Could not copy documents: {}".format(failures))
+
+        swap_alias(alias, new_index, delete_old=delete_old, replace_index=replace_index)
+    return new_index
+
+
+def get_alias_indexes(alias: str, replace_index=False) -> list:
+    """
+    Get the indexes an alias points to
+
+    Raises `ReindexError` if there is an index with the same name as the
+    alias, unless `replace_index` is true.
+    """
+    es = get_db()
+    if es.indices.exists_alias(name=alias):
+        return list(es.indices.get_alias(name=alias).keys())
+    if es.indices.exists(index=alias):
+        if not replace_index:
+            raise ReindexError(
+                "{} is an index rather than an alias. It has to be deleted to "
+                "create the alias - use --replace-index to do this".format(alias)
+            )
+        return [alias]
+    return []
+
+
+@contextmanager
+def write_block(indexes: list):
+    """
+    Stop documents being added, changed or deleted in `indexes`
+
+    The block is removed afterwards from any of the indexes that still exist.
+    """
+    es = get_db()
+    if not indexes:
+        yield
+        return
+    index = ",".join(indexes)
+    es.indices.put_settings(index=index, body={"index.blocks.write": True})
+    try:
+        yield
+    finally:
+        es.indices.put_settings(
+            index=index,
+            body={"index.blocks.write": None},
+            ignore_unavailable=True,
+        )
+
+
+def swap_alias(alias: str, new_index: str, delete_old=False, replace_index=False):
+    """
+    Point an alias at a new index, in a single atomic action
+
+    The indexes the alias pointed to before are deleted if `delete_old`
+    is true. An index with the same name as the alias is only deleted if
+    `replace_index` is true, otherwise `ReindexError` is raised.
+    """
+    es = get_db()
+    actions = [{"add": {"index": new_index, "alias": alias}}]
+    old_indexes = get_alias_indexes(alias, replace_index=replace_index)
+    if old_indexes == [alias]:
+        # indexes created before the mapping was managed aren't behind an
+        # alias, and the alias can't be created until the index has gone
+        actions.insert(0, {"remove_index": {"index": alias}})
+    else:
+        for old_index in old_indexes:
+            if delete_old:
+                actions.append({"remove_index": {"index": old_index}})
+            else:
+                actions.append({"remove": {"index": old_index, "alias": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+
+
+@contextmanager
+def bulk_load_settings(index: str, refresh_interval: str = "-1", replicas: int = 0):
+    """
+    Relax the index settings while loading lots of documents
+
+    Refreshes are turned off and replicas removed while loading, and the
+    original settings are put back afterwards.
+    """
+    es = get_db()
+    names = ["index.refresh_interval", "index.number_of_replicas"]
+    original = {
+        name: index_settings["settings"].get("index", {})
+        for name, index_settings in es.indices.get_settings(
+            index=index, name=names
+        ).items()
+    }
+    es.indices.put_settings(
+        index=index,
+        body={
+            "index": {
+                "refresh_interval": refresh_interval,
+                "number_of_replicas": replicas,
+            }
+        },
+    )
+    try:
+        yield
+    finally:
+        for name, settings in original.items():
+            es.indices.put_settings(
+                index=name,
+                body={
+                    "index": {
+                        # settings that weren't set go back to the default
+                        "refresh_interval": settings.get("refresh_interval"),
+                        "number_of_replicas": settings.get("number_of_replicas"),
+                    }
+                },
+            )
+        es.indices.refresh(index=index)
+
+
+def reverse_sort(sort: list) -> list:
+    return [
+        {field: "asc" if order == "desc" else "desc"}
+        for sort_field in sort
+        for field, order in sort_field.items()
+    ]
+
+
+def search_page(es, body: dict, sort: list, limit: int, cursor: dict = None, **kwargs):
+    """
+    Get one page of search results using `search_after`
+
+    `sort` must give every document a unique position, eg by ending with
+    `_id`. The `cursor` (see `docdisplay.utils.get_nav`) holds the sort
+    values of the result before the page, or after it if `reverse` is set,
+    so every page costs the same however deep it is. A reversed cursor
+    without any values gets the last page.
+
+    Returns the page number, the results and the total number of results.
+    """
+    cursor = cursor or {}
+    reverse = cursor.get("reverse", False)
+    body = {**body, "size": limit, "sort": reverse_sort(sort) if reverse else sort}
+    if cursor.get("after"):
+        body["search_after"] = cursor["after"]
+    res = es.search(body=body, **kwargs)
+    total = res.get("hits", {}).get("total", 0)
+    if isinstance(total, dict):
+        total = total.get("value")
+    results = res.get("hits", {}).get("hits", [])
+    page = max(int(cursor.get("p", 1)), 1)
+    if reverse:
+        if not cursor.get("after"):
+            page = max(math.ceil(total / limit), 1)
+            results = results[: total - ((page - 1) * limit)]
+        results = results[::-1]
+    return page, results, total
 
 
 def init_app(app):
-    app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
     app.cli.add_command(update_db_setting_command)
+    app.cli.add_command(reindex_command)
 
 
 @click.command("init-db")
@@ -35,6 +429,53 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("reindex")
+@click.option(
+    "--index",
+    "settings",
+    type=click.Choice(list(INDEXES.keys())),
+    multiple=True,
+    help="Config setting naming the index to rebuild (default: all)",
+)
+@click.option(
+    "--delete-old/--keep-old",
+    default=False,
+    help="Delete the old index once the alias has moved",
+)
+@click.option(
+    "--replace-index",
+    is_flag=True,
+    help="Delete an index with the same name as the alias, so the alias can be created",
+)
+@with_appcontext
+def reindex_command(settings, delete_old, replace_index):
+    """Rebuild indexes with the current mapping and swap their aliases."""
+    for setting in settings or INDEXES.keys():
+        alias = current_app.config[setting]
+        click.echo(f"Reindexing {alias}")
+
+        def echo_progress(status):
+            click.echo(
+                "{copied} of {total} documents copied".format(
+                    copied=status.get("created", 0) + status.get("updated", 0),
+                    total=status.get("total", 0),
+                )
+            )
+
+        try:
+            new_index = reindex(
+                alias,
+                INDEXES[setting],
+                delete_old=delete_old,
+                replace_index=replace_index,
+                progress=echo_progress,
+            )
+        except ReindexError as err:
+            raise click.ClickException(str(err))
+        click.echo(f"{alias} now points to {new_index}")
+    clear_query_cache()
+
+
 @click.command("update-index-setting")
 @click.argument("name")
 @click.argument("value")
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import elasticsearch
+from elasticsearch import ConnectionTimeout, Transport, TransportError
+from elasticsearch.connection import Urllib3HttpConnection
+
+from docdisplay.metrics import ES_REQUEST_SECONDS, ES_TOOK_SECONDS, record_error
+
+
+class PoolStats:
+    """
+    Counts of the requests made by the elasticsearch client in this process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.calls = 0
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> dict:
+        return {
+            "in_use": self.in_use,
+            "calls": self.calls,
+            "requests": self.requests,
+            # each request after the first for a call is a retry
+            "retries": self.requests - self.calls,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+        }
+
+
+class StatsConnection(Urllib3HttpConnection):
+    """
+    Connection to an elasticsearch node which records its use in `stats`
+    """
+
+    stats = None
+
+    def perform_request(self, *args, **kwargs):
+        self.stats.add("requests")
+        self.stats.add("in_use")
+        try:
+            return super().perform_request(*args, **kwargs)
+        except ConnectionTimeout as err:
+            self.stats.add("timeouts")
+            record_error("elasticsearch", err)
+            raise
+        except TransportError as err:
+            # 404s and other client errors are expected responses
+            if not isinstance(err.status_code, int) or err.status_code >= 500:
+                self.stats.add("failures")
+                record_error("elasticsearch", err)
+            raise
+        finally:
+            self.stats.add("in_use", -1)
+
+
+class StatsTransport(Transport):
+    """
+    Transport which records each call and sets a timeout for each type of call
+
+    `request_timeouts` maps the endpoint of a request (eg `_search` or
+    `_bulk`) to its timeout, used unless the call sets `request_timeout`.
+    The time taken by each call, and the time elasticsearch reports it
+    took, are recorded in the metrics for its endpoint.
+    """
+
+    stats = None
+    request_timeouts = {}
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        self.stats.add("calls")
+        endpoint = url.rstrip("/").rsplit("/", 1)[-1]
+        timeout = self.request_timeouts.get(endpoint)
+        if timeout and "request_timeout" not in (params or {}):
+            params = {**(params or {}), "request_timeout": timeout}
+        start = time.perf_counter()
+        result = super().perform_request(
+            method, url, headers=headers, params=params, body=body
+        )
+        # requests for a single document or index end with its name, so are
+        # grouped by their method instead
+        endpoint = endpoint if endpoint.startswith("_") else method
+        ES_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+        if isinstance(result, dict) and "took" in result:
+            ES_TOOK_SECONDS.labels(endpoint).observe(result["took"] / 1000)
+        return result
+
+
+def create_client(config) -> elasticsearch.Elasticsearch:
+    stats = PoolStats()
+    connection_class = type("StatsConnection", (StatsConnection,), {"stats": stats})
+    transport_class = type(
+        "StatsTransport",
+        (StatsTransport,),
+        {
+            "stats": stats,
+            "request_timeouts": config.get("ES_REQUEST_TIMEOUTS") or {},
+        },
+    )
+    client = elasticsearch.Elasticsearch(
+        config["ES_URL"],
+        connection_class=connection_class,
+        transport_class=transport_class,
+        maxsize=config.get("ES_POOL_MAXSIZE", 10),
+        timeout=config.get("ES_TIMEOUT", 10),
+        max_retries=config.get("ES_MAX_RETRIES", 3),
+        retry_on_timeout=config.get("ES_RETRY_ON_TIMEOUT", False),
+    )
+    client.pool_stats = stats
+    return client
@@ -0,0 +1,111 @@
+import csv
+import json
+
+from flask import Response, stream_with_context
+
+# fields of a document that can be exported
+EXPORT_FIELDS = [
+    "regno",
+    "fye",
+    "filename",
+    "name",
+    "income",
+    "spending",
+    "assets",
+]
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+}
+
+# number of rows put together into each chunk of the response
+ROWS_PER_CHUNK = 500
+
+
+class ExportError(Exception):
+    pass
+
+
+class _Echo:
+    """
+    File-like object that returns what is written, so csv rows aren't buffered
+    """
+
+    def write(self, value):
+        return value
+
+
+def get_export_fields(fields: str = None, default=EXPORT_FIELDS) -> list:
+    """
+    Get the list of fields to export from a comma separated string
+    """
+    if not fields:
+        return list(default)
+    fields = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in EXPORT_FIELDS]
+    if unknown:
+        raise ExportError("Unknown fields: {}".format(", ".join(unknown)))
+    return fields
+
+
+def get_rows(es, fields: list, extra: dict = None, **kwargs):
+    """
+    Get each matching document as a row containing `fields`
+
+    Results are fetched from elasticsearch a page at a time using a
+    scroll, so only one page is held in memory. `extra` is added to every
+    row, and other arguments are passed to `scan`.
+    """
+    from elasticsearch.helpers import scan
+
+    extra = extra or {}
+    source_fields = [field for field in fields if field not in extra]
+    for result in scan(es, _source_includes=source_fields, **kwargs):
+        yield {
+            **{field: result["_source"].get(field) for field in source_fields},
+            **extra,
+        }
+
+
+def stream_csv(rows, fields: list):
+    writer = csv.DictWriter(_Echo(), fieldnames=fields, extrasaction="ignore")
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_jsonl(rows, fields: list):
+    for row in rows:
+        yield json.dumps({field: row.get(field) for field in fields}) + "\n"
+
+
+EXPORT_WRITERS = {
+    "csv": stream_csv,
+    "jsonl": stream_jsonl,
+}
+
+
+def chunk_lines(lines, size: int = ROWS_PER_CHUNK):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def export_response(rows, fields: list, filetype: str, filename: str) -> Response:
+    """
+    Stream rows to the client as a CSV or newline-delimited JSON file
+    """
+    lines = EXPORT_WRITERS[filetype](rows, fields)
+    return Response(
+        stream_with_context(chunk_lines(lines)),
+        mimetype=EXPORT_FORMATS[filetype],
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}.{filetype}",
+        },
+    )
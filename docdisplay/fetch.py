@@ -4,25 +4,47 @@ import logging
 import os
 import re
 import sys
+import threading
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date, datetime
+from urllib.parse import urljoin
 
 import click
 import dateutil.parser
+import lxml.html
 import requests
 from flask import current_app
 from flask.cli import AppGroup
-from graphqlclient import GraphQLClient
-from requests import Session
-from requests_html import HTMLSession
 from tqdm import tqdm
 
+from docdisplay.cache import get_listing_cache, get_organisation_numbers
 from docdisplay.cc_api import CharityCommissionAPI
+from docdisplay.db import get_db
+from docdisplay.http_cache import get_session, get_timeout
+from docdisplay.journal import FetchJournal
+from docdisplay.metrics import (
+    DOWNLOAD_BYTES,
+    DOWNLOAD_SECONDS,
+    LISTING_FETCH_SECONDS,
+    LISTING_PARSE_SECONDS,
+    push_metrics_after,
+    record_cache,
+    record_error,
+)
+from docdisplay.throttle import DEFAULT_HOST_LIMITS, HostLimiter
+from docdisplay.upload import check_existing, upload_doc
 from docdisplay.utils import parse_datetime
 
 fetch_cli = AppGroup("fetch")
 
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (10, 60)  # seconds to connect, and between bytes received
+DOWNLOAD_RETRIES = 3
+CCEW_DETAILS_BATCH_SIZE = 20  # charities per GetCharityDetailsMulti request
+
 Account = namedtuple("Account", ["url", "fyend", "regno", "size"], defaults=[None])
 
 
@@ -30,57 +52,245 @@ class CharityFetchError(Exception):
     pass
 
 
-class CCEW:
+def parse_html(content: bytes):
+    if not content or not content.strip():
+        # lxml can't parse an empty document
+        content = b"<html></html>"
+    return lxml.html.fromstring(content)
+
+
+def has_class(name: str) -> str:
+    """
+    XPath condition for elements with a class, like the CSS selector `.name`
+    """
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+def get_text(element) -> str:
+    """
+    Get the text of an element and its children, with whitespace collapsed
+    """
+    return " ".join(element.text_content().split())
+
+
+def get_base_url(html, url: str) -> str:
+    base = html.find(".//base[@href]")
+    if base is not None:
+        return urljoin(url, base.get("href").strip())
+    return url
+
+
+def get_absolute_links(element, base_url: str) -> list:
+    """
+    Get the links within an element, relative to `base_url`
+    """
+    links = []
+    for link in element.xpath(".//a[@href]"):
+        href = link.get("href").strip()
+        if not href or href.startswith("#") or href.startswith("javascript:"):
+            continue
+        href = urljoin(base_url, href)
+        if href not in links:
+            links.append(href)
+    return links
+
+
+class Regulator:
+    """
+    Base class for the regulators accounts can be fetched from
+
+    Subclasses implement `get_charity_url` to give the page on the
+    regulator's website that lists a charity's accounts, and
+    `parse_accounts` to find the accounts on that page.
+    """
+
+    name = None
+
+    def __init__(self, cache=None):
+        self.cache = cache
+
+    def list_accounts(self, regno: str, session=None, refresh: bool = False) -> list:
+        """
+        List accounts for a charity, using the listing cache if there is one
+
+        Lists are only cached once they have been fetched successfully.
+        """
+        if self.cache and not refresh:
+            accounts = self.cache.get(self.name, regno)
+            record_cache("listing", accounts is not None)
+            if accounts is not None:
+                return [Account(**a) for a in accounts]
+        accounts = self.fetch_accounts(regno, session=session, refresh=refresh)
+        if self.cache:
+            self.cache.set(self.name, regno, accounts)
+        return accounts
+
+    def get_charity_url(self, regno: str) -> str:
+        raise NotImplementedError
+
+    def parse_accounts(self, content: bytes, regno: str, url: str) -> list:
+        raise NotImplementedError
+
+    def fetch_accounts(self, regno: str, session=None, refresh: bool = False) -> list:
+        """
+        List accounts for a charity
+
+        If `refresh` is set then the page is fetched again even if the HTTP
+        cache has a copy, and the new copy replaces it.
+
+        Raises `CharityFetchError` if the regulator responds with an error
+        (once any retries have run out), rather than returning an empty list.
+        """
+        if not session:
+            session = get_session("listing")
+        url = self.get_charity_url(regno)
+        logging.debug("Fetching account list: {}".format(url))
+
+        # "no-cache" makes requests_cache skip reading the cache but still
+        # save the response, and is safe to use with a shared session
+        headers = {"Cache-Control": "no-cache"} if refresh else {}
+        with LISTING_FETCH_SECONDS.labels(self.name).time():
+            r = session.get(url, headers=headers, timeout=get_timeout())
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError as err:
+            record_error("listing", err)
+            logging.error("Could not fetch account list: {}".format(err))
+            if r.status_code == requests.codes.not_found:
+                raise CharityFetchError("Charity {} not found".format(regno)) from err
+            # overloaded servers have already been retried by the session
+            raise CharityFetchError("HTTP error {}".format(r.status_code)) from err
+        with LISTING_PARSE_SECONDS.labels(self.name).time():
+            accounts = self.parse_accounts(r.content, regno, r.url)
+        return sorted(accounts, key=lambda x: x.fyend, reverse=True)
+
+    def get_charity(self, regno: str):
+        return None
+
+
+class CCEW(Regulator):
 
     name = "ccew"
     url_base = "https://register-of-charities.charitycommission.gov.uk/charity-search/-/charity-details/{}/accounts-and-annual-returns"
     date_regex = r"([0-9]{1,2} [A-Za-z]+ [0-9]{4})"
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, limiter=None, cache=None, organisation_numbers=None):
+        super().__init__(cache=cache)
         self.api_key = api_key
-        self.api = CharityCommissionAPI(self.api_key, session=Session())
+        self.limiter = limiter
+        self._api = None
+        self.organisation_numbers = organisation_numbers
+        self._details = {}
+        self._details_lock = threading.Lock()
+
+    @property
+    def api(self):
+        # the API session is only opened when the API is first used, as
+        # lists of accounts are often found in the listing cache instead
+        if self._api is None:
+            self._api = CharityCommissionAPI(
+                self.api_key,
+                session=get_session("api"),
+                limiter=self.limiter,
+                timeout=get_timeout(),
+            )
+        return self._api
 
     def _get_regno(self, regno):
         return regno.lstrip("GB-CHC-")
 
-    def get_charity_url(self, regno):
+    def get_charity_details(self, regno):
+        """
+        Fetch the charity details from the API
+
+        The result is kept so `list_accounts` and `get_charity` only make
+        one request between them, even when they run at the same time.
+        """
+        regno = self._get_regno(regno)
+        with self._details_lock:
+            if regno not in self._details:
+                self._details[regno] = self.api.GetCharityDetails(
+                    RegisteredNumber=regno
+                )
+        return self._details[regno]
+
+    def get_organisation_number(self, regno):
         regno = self._get_regno(regno)
-        org_details = self.api.GetCharityDetails(RegisteredNumber=regno)
+        if self.organisation_numbers:
+            organisation_number = self.organisation_numbers.get(regno)
+            if organisation_number:
+                return organisation_number
+        org_details = self.get_charity_details(regno)
         if "organisation_number" not in org_details:
             raise CharityFetchError("Charity {} not found".format(regno))
-        return self.url_base.format(org_details["organisation_number"])
+        if self.organisation_numbers:
+            self.organisation_numbers.update(
+                {regno: org_details["organisation_number"]}
+            )
+        return org_details["organisation_number"]
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
+    def load_organisation_numbers(self, regnos: list, progress: bool = False):
         """
-        List accounts for a charity
+        Look up the organisation numbers for a list of charities in bulk
+
+        Only charities that aren't already in the organisation number map
+        are looked up, using `GetCharityDetailsMulti`.
         """
-        url = self.get_charity_url(regno)
-        logging.debug("Fetching account list: {}".format(url))
+        if not self.organisation_numbers:
+            return
+        missing = self.organisation_numbers.missing(
+            [self._get_regno(regno) for regno in regnos]
+        )
+        batches = range(0, len(missing), CCEW_DETAILS_BATCH_SIZE)
+        for i in tqdm(batches, disable=not progress):
+            batch = missing[i : i + CCEW_DETAILS_BATCH_SIZE]
+            try:
+                results = self.api.GetCharityDetailsMulti(
+                    RegisteredNumbers=",".join(batch)
+                )
+            except requests.exceptions.RequestException as err:
+                # these charities will be looked up one at a time instead
+                logging.warning("Could not fetch organisation numbers: {}".format(err))
+                continue
+            self.organisation_numbers.update(
+                {
+                    str(c["reg_charity_number"]): c["organisation_number"]
+                    for c in results or []
+                    if c.get("organisation_number") and not c.get("group_subsid_suffix")
+                }
+            )
 
-        r = session.get(url)
+    def get_charity_url(self, regno):
+        return self.url_base.format(self.get_organisation_number(regno))
+
+    def parse_accounts(self, content: bytes, regno: str, url: str) -> list:
         accounts = []
-        for tr in r.html.find("tr.govuk-table__row"):
-            cells = list(tr.find("td"))
-            cell_text = [c.text.strip() if c.text else "" for c in cells]
+        for tr in parse_html(content).xpath(
+            "//tr[{}]".format(has_class("govuk-table__row"))
+        ):
+            cells = tr.xpath(".//td")
+            cell_text = [get_text(c) for c in cells]
             if not cell_text or "accounts" not in cell_text[0].lower():
                 continue
-            if not cells[-1].find("a"):
+            links = cells[-1].xpath(".//a")
+            if not links:
                 continue
             date_string = re.match(self.date_regex, cell_text[1])
             if date_string:
                 accounts.append(
                     Account(
                         regno=regno,
-                        url=cells[-1].find("a", first=True).attrs["href"],
+                        url=links[0].get("href"),
                         fyend=dateutil.parser.parse(date_string.group()).date(),
                     )
                 )
-        return sorted(accounts, key=lambda x: x.fyend, reverse=True)
+        return accounts
 
     def get_charity(self, regno: str):
-        regno = self._get_regno(regno)
-        org_details = self.api.GetCharityDetails(RegisteredNumber=regno)
-        finances = self.api.GetCharityFinancialHistory(RegisteredNumber=regno)
+        org_details = self.get_charity_details(regno)
+        finances = self.api.GetCharityFinancialHistory(
+            RegisteredNumber=self._get_regno(regno)
+        )
         return {
             "name": org_details["charity_name"],
             "finances": [
@@ -94,7 +304,7 @@ class CCEW:
         }
 
 
-class CCNI:
+class CCNI(Regulator):
 
     name = "ccni"
     url_base = (
@@ -109,35 +319,26 @@ class CCNI:
     def get_charity_url(self, regno):
         return self.url_base.format(self._get_regno(regno))
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
-        """
-        List accounts for a charity
-        """
-        url = self.get_charity_url(regno)
-        logging.debug("Fetching account list: {}".format(url))
-
-        r = session.get(url)
+    def parse_accounts(self, content: bytes, regno: str, url: str) -> list:
         accounts = []
-        for link in r.html.find("article#documents a"):
-            if not link.attrs["href"].endswith("_CA.pdf"):
+        for link in parse_html(content).xpath("//article[@id='documents']//a"):
+            href = link.get("href", "")
+            if not href.endswith("_CA.pdf"):
                 continue
-            match = re.match(self.account_url_regex, link.attrs["href"])
+            match = re.match(self.account_url_regex, href)
             if not match:
                 continue
             accounts.append(
                 Account(
                     regno=match.group(1).lstrip("0"),
-                    url=link.attrs["href"],
+                    url=href,
                     fyend=dateutil.parser.parse(match.group(2)).date(),
                 )
             )
-        return sorted(accounts, key=lambda x: x.fyend, reverse=True)
-
-    def get_charity(self, regno: str):
-        return None
+        return accounts
 
 
-class OSCR:
+class OSCR(Regulator):
     name = "oscr"
     url_base = "https://www.oscr.org.uk/about-charities/search-the-register/charity-details?number={}"
 
@@ -147,24 +348,21 @@ class OSCR:
     def get_charity_url(self, regno):
         return self.url_base.format(self._get_regno(regno))
 
-    def list_accounts(self, regno: str, session=HTMLSession()) -> list:
-        """
-        List accounts for a charity
-        """
-        url = self.get_charity_url(regno)
-        logging.debug("Fetching account list: {}".format(url))
-
-        r = session.get(url)
+    def parse_accounts(self, content: bytes, regno: str, url: str) -> list:
+        html = parse_html(content)
+        base_url = get_base_url(html, url)
         accounts = []
-        for tr in r.html.find(".history table tr"):
-            cells = tr.find("td")
+        for tr in html.xpath("//*[{}]//table//tr".format(has_class("history"))):
+            cells = tr.xpath(".//td")
+            if not cells:
+                continue
             try:
-                fyend = dateutil.parser.parse(cells[0].text).date()
+                fyend = dateutil.parser.parse(get_text(cells[0])).date()
             except dateutil.parser.ParserError:
                 continue
             if len(cells) != 6:
                 continue
-            links = list(cells[5].absolute_links)
+            links = get_absolute_links(cells[5], base_url)
             if not links or links[0] in (
                 "https://beta.companieshouse.gov.uk",
                 "https://www.gov.uk/government/organisations/charity-commission",
@@ -177,18 +375,27 @@ class OSCR:
                     fyend=fyend,
                 )
             )
-        return sorted(accounts, key=lambda x: x.fyend, reverse=True)
-
-    def get_charity(self, regno: str):
-        return None
+        return accounts
 
 
-def get_charity_type(regno):
+def get_regulator(regno):
     if regno.startswith("SC") or regno.startswith("GB-SC-"):
-        return OSCR()
+        return OSCR
     if regno.startswith("NI") or regno.startswith("GB-NIC-"):
-        return CCNI()
-    return CCEW(api_key=current_app.config.get("CCEW_API_KEY"))
+        return CCNI
+    return CCEW
+
+
+def get_charity_type(regno, limiter=None):
+    regulator = get_regulator(regno)
+    if regulator is CCEW:
+        return CCEW(
+            api_key=current_app.config.get("CCEW_API_KEY"),
+            limiter=limiter,
+            cache=get_listing_cache(),
+            organisation_numbers=get_organisation_numbers(),
+        )
+    return regulator(cache=get_listing_cache())
 
 
 class StripLinkText(str):
@@ -201,49 +408,188 @@ def print_header(s: str, underline: str = "="):
     print(underline * len(s))
 
 
+def get_account_filename(regno: str, fyend: date) -> str:
+    return "{}_{:%Y%m%d}.pdf".format(regno, fyend)
+
+
+def is_valid_pdf(path: str) -> bool:
+    """
+    Check that a file exists and looks like a complete PDF
+    """
+    if not os.path.isfile(path) or not os.path.getsize(path):
+        return False
+    with open(path, "rb") as f:
+        if not f.read(5) == b"%PDF-":
+            return False
+        f.seek(max(os.path.getsize(path) - 1024, 0))
+        return b"%%EOF" in f.read()
+
+
+def get_expected_size(r) -> int:
+    """
+    Get the full size of the file from the headers of a response
+    """
+    if r.status_code == requests.codes.partial_content:
+        match = re.match(r"bytes \d+-\d+/(\d+)", r.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+    if r.headers.get("Content-Length") and not r.headers.get("Content-Encoding"):
+        return int(r.headers["Content-Length"])
+    return None
+
+
+def get_validator(r) -> str:
+    """
+    Get the value identifying this version of a file, to send as If-Range
+
+    Weak ETags can't be used with If-Range, so Last-Modified is used instead.
+    """
+    etag = r.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return r.headers.get("Last-Modified")
+
+
 def download_account(
     url: str,
     regno: str,
     fyend: date,
     destination: str = ".",
     session=None,
+    timeout=DOWNLOAD_TIMEOUT,
+    retries: int = DOWNLOAD_RETRIES,
 ) -> dict:
     """
     Download a charity account from an URL
+
+    The file is streamed to a ".part" file next to the destination and
+    only renamed into place once it is complete. If the transfer is
+    interrupted it is resumed from where it stopped, using a Range request
+    if the server supports them. The ETag or Last-Modified date of the file
+    is kept in a ".part.validator" file and sent as If-Range, so if the
+    file has changed since, the server sends the whole of the new one.
+    Partial files without a validator are downloaded again from the start.
     """
 
     if not session:
-        session = requests.Session()
-
-    filename = "{}_{:%Y%m%d}.pdf".format(regno, fyend)
-    try:
-        r = session.get(url)
-        logging.debug("Fetching account PDF: {}".format(url))
-    except requests.exceptions.SSLError:
-        logging.warning("SSL Error for account: {}".format(url))
-        r = session.get(url, verify=False)
-    if getattr(r, "from_cache", False):
-        logging.debug("Used cache")
-    try:
-        r.raise_for_status()
-    except requests.exceptions.HTTPError:
-        logging.error("Account not found: {}".format(url))
-        return {"error": "Account not found"}
-
-    if not os.path.exists(destination):
-        logging.debug("Creating directory: {}".format(destination))
-        os.makedirs(destination)
+        session = get_session("pdf")
 
+    filename = get_account_filename(regno, fyend)
     dest = os.path.join(destination, filename)
+    partial = dest + ".part"
+    validator_path = partial + ".validator"
+
+    verify = True
+    start = time.monotonic()
+    ttfb = None
+    bytes_downloaded = 0
+    attempt = 0
+    while True:
+        resume_from = os.path.getsize(partial) if os.path.exists(partial) else 0
+        validator = None
+        if resume_from and os.path.exists(validator_path):
+            with open(validator_path) as f:
+                validator = f.read().strip()
+        headers = {}
+        if resume_from and validator:
+            headers = {"Range": "bytes={}-".format(resume_from), "If-Range": validator}
+        try:
+            logging.debug("Fetching account PDF: {}".format(url))
+            r = session.get(
+                url, headers=headers, stream=True, timeout=timeout, verify=verify
+            )
+        except requests.exceptions.SSLError:
+            if not verify:
+                raise
+            logging.warning("SSL Error for account: {}".format(url))
+            verify = False
+            continue
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            attempt += 1
+            if attempt > retries:
+                raise
+            logging.warning("Retrying account: {}".format(url))
+            continue
+
+        with r:
+            if ttfb is None:
+                ttfb = r.elapsed.total_seconds()
+            if getattr(r, "from_cache", False):
+                logging.debug("Used cache")
+            if r.status_code == requests.codes.range_not_satisfiable:
+                # the partial file doesn't match what's on the server
+                logging.debug("Could not resume, restarting: {}".format(url))
+                os.remove(partial)
+                if os.path.exists(validator_path):
+                    os.remove(validator_path)
+                continue
+            try:
+                r.raise_for_status()
+            except requests.exceptions.HTTPError as err:
+                record_error("download", err)
+                if r.status_code == requests.codes.not_found:
+                    logging.error("Account not found: {}".format(url))
+                    return {"error": "Account not found"}
+                # overloaded servers have already been retried by the session
+                logging.error("Could not download account: {}".format(err))
+                return {"error": "HTTP error {}".format(r.status_code)}
+
+            if not os.path.exists(destination):
+                logging.debug("Creating directory: {}".format(destination))
+                os.makedirs(destination)
+
+            # servers that ignore the Range header, or whose copy has changed,
+            # send the whole file again
+            mode = "ab" if r.status_code == requests.codes.partial_content else "wb"
+            if mode == "wb":
+                validator = get_validator(r)
+                if validator:
+                    with open(validator_path, "w") as f:
+                        f.write(validator)
+                elif os.path.exists(validator_path):
+                    os.remove(validator_path)
+            try:
+                with open(partial, mode) as f:
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        bytes_downloaded += len(chunk)
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ):
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logging.warning("Download interrupted, resuming: {}".format(url))
+                continue
+
+            # the connection can close early without raising an error
+            expected_size = get_expected_size(r)
+            if expected_size and os.path.getsize(partial) < expected_size:
+                attempt += 1
+                if attempt > retries:
+                    raise CharityFetchError("Incomplete download: {}".format(url))
+                logging.warning("Download incomplete, resuming: {}".format(url))
+                continue
+        break
+
     logging.debug("Saving to: {}".format(dest))
-    with open(dest, "wb") as f:
-        f.write(r.content)
+    os.replace(partial, dest)
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+    timetaken = time.monotonic() - start
+    DOWNLOAD_BYTES.observe(bytes_downloaded)
+    DOWNLOAD_SECONDS.observe(timetaken)
 
     return {
         "file_location": dest,
         "file_name": filename,
-        "file_size": len(r.content),
-        "download_timetaken": r.elapsed.total_seconds(),
+        "file_size": os.path.getsize(dest),
+        "download_timetaken": timetaken,
+        "download_ttfb": ttfb,
+        "download_bytes_per_second": bytes_downloaded / timetaken
+        if timetaken
+        else None,
         "regno": regno,
         "fyend": fyend,
     }
@@ -252,14 +598,22 @@ def download_account(
 @fetch_cli.command("list")
 @click.argument("regno")
 @click.option("--destination", default=".", help="Folder in which to save accounts")
-def list_accounts_for_download(regno: str, destination: str = ".", **kwargs: dict):
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
+def list_accounts_for_download(
+    regno: str, destination: str = ".", refresh: bool = False, **kwargs: dict
+):
     """List all accounts for charity number REGNO.
 
     \b
     REGNO is the charity number
     """
     source = get_charity_type(regno)
-    accounts = source.list_accounts(regno)
+    accounts = source.list_accounts(regno, refresh=refresh)
     if not accounts:
         print("No accounts found for charity number {}".format(regno))
         exit()
@@ -282,14 +636,22 @@ def list_accounts_for_download(regno: str, destination: str = ".", **kwargs: dic
 @fetch_cli.command("latest")
 @click.argument("regno")
 @click.option("--destination", default=".", help="Folder in which to save accounts")
-def download_latest_account(regno: str, destination: str = ".", **kwargs: dict):
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
+def download_latest_account(
+    regno: str, destination: str = ".", refresh: bool = False, **kwargs: dict
+):
     """Download the latest account for charity number REGNO.
 
     \b
     REGNO is the charity number
     """
     source = get_charity_type(regno)
-    accounts = source.list_accounts(regno)
+    accounts = source.list_accounts(regno, refresh=refresh)
     download_account(
         accounts[0].url,
         regno=regno,
@@ -301,15 +663,25 @@ def download_latest_account(regno: str, destination: str = ".", **kwargs: dict):
 @fetch_cli.command("all")
 @click.argument("regno")
 @click.option("--destination", default=".", help="Folder in which to save accounts")
-def download_all_accounts(regno: str, destination: str = ".", **kwargs: dict):
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
+def download_all_accounts(
+    regno: str, destination: str = ".", refresh: bool = False, **kwargs: dict
+):
     """Download all available accounts for charity number REGNO.
 
     \b
     REGNO is the charity number
     """
-    session = HTMLSession()
     source = get_charity_type(regno)
-    accounts = source.list_accounts(regno, session=session)
+    accounts = source.list_accounts(
+        regno, session=get_session("listing"), refresh=refresh
+    )
+    session = get_session("pdf")
     for a in accounts:
         download_account(
             a.url,
@@ -324,16 +696,26 @@ def download_all_accounts(regno: str, destination: str = ".", **kwargs: dict):
 @click.argument("regno")
 @click.argument("fyend", type=parse_datetime)
 @click.option("--destination", default=".", help="Folder in which to save accounts")
-def download_account_parser(regno: str, fyend: date, destination: str = ".", **kwargs):
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
+def download_account_parser(
+    regno: str, fyend: date, destination: str = ".", refresh: bool = False, **kwargs
+):
     """Download account for FYEND for REGNO.
 
     \b
     REGNO is the charity number
     FYEND is the financial year end of the accounts (format YYYY-MM-DD)
     """
-    session = HTMLSession()
     source = get_charity_type(regno)
-    accounts = source.list_accounts(regno, session=session)
+    accounts = source.list_accounts(
+        regno, session=get_session("listing"), refresh=refresh
+    )
+    session = get_session("pdf")
     for account in accounts:
         if account.fyend == fyend:
             download_account(
@@ -373,6 +755,55 @@ def download_account_parser(regno: str, fyend: date, destination: str = ".", **k
     default=0,
     help="Number of rows to skip when parsing file",
 )
+@click.option(
+    "--journal",
+    "journal_path",
+    type=click.Path(),
+    help="""File to record the outcome of each row in, so the job can be
+    resumed (defaults to the logfile name with ".journal" added)""",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="""Only fetch rows that the journal doesn't show as finished, and
+    skip accounts that have already been downloaded""",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of rows to fetch at the same time",
+)
+@click.option(
+    "--ccew-workers",
+    type=int,
+    default=DEFAULT_HOST_LIMITS["ccew"],
+    help="Maximum concurrent requests to the Charity Commission register",
+)
+@click.option(
+    "--ccni-workers",
+    type=int,
+    default=DEFAULT_HOST_LIMITS["ccni"],
+    help="Maximum concurrent requests to the Northern Ireland Charity Commission",
+)
+@click.option(
+    "--oscr-workers",
+    type=int,
+    default=DEFAULT_HOST_LIMITS["oscr"],
+    help="Maximum concurrent requests to OSCR",
+)
+@click.option(
+    "--api-workers",
+    type=int,
+    default=DEFAULT_HOST_LIMITS["ccapi"],
+    help="Maximum concurrent requests to the Charity Commission API",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
 def download_from_csv(
     csvfile,
     regno_column: str = "regno",
@@ -380,11 +811,39 @@ def download_from_csv(
     destination: str = ".",
     logfile=None,
     skip_rows: int = 0,
+    journal_path=None,
+    resume: bool = False,
+    workers: int = 1,
+    ccew_workers: int = DEFAULT_HOST_LIMITS["ccew"],
+    ccni_workers: int = DEFAULT_HOST_LIMITS["ccni"],
+    oscr_workers: int = DEFAULT_HOST_LIMITS["oscr"],
+    api_workers: int = DEFAULT_HOST_LIMITS["ccapi"],
+    refresh: bool = False,
     **kwargs
 ):
     """Download accounts for a selection of charities from CSVFILE"""
+    if not journal_path and logfile:
+        journal_path = logfile + ".journal"
+    if resume and not journal_path:
+        raise click.UsageError("--resume needs a --journal or --logfile")
+    journal = FetchJournal(journal_path, resume=resume) if journal_path else None
+
     reader = csv.DictReader(csvfile)
-    session = HTMLSession()
+    rows = [
+        (k, row)
+        for k, row in enumerate(reader)
+        if k >= skip_rows and not (journal and journal.is_done(k, row[regno_column]))
+    ]
+    app = current_app._get_current_object()
+    limiter = HostLimiter(
+        {
+            "ccew": ccew_workers,
+            "ccni": ccni_workers,
+            "oscr": oscr_workers,
+            "ccapi": api_workers,
+        }
+    )
+    thread_data = threading.local()
 
     logging_fields = [
         "success",
@@ -394,34 +853,79 @@ def download_from_csv(
         "file_name",
         "file_size",
         "download_timetaken",
+        "download_ttfb",
+        "download_bytes_per_second",
         "regno",
         "fyend",
     ]
 
+    def get_thread_session(policy, session_class=requests.Session):
+        # sessions aren't shared between threads
+        if not hasattr(thread_data, policy):
+            setattr(thread_data, policy, get_session(policy, session_class))
+        return getattr(thread_data, policy)
+
+    def get_existing_file(regno, fyend):
+        dest = os.path.join(destination, get_account_filename(regno, fyend))
+        if resume and is_valid_pdf(dest):
+            return {
+                "file_location": dest,
+                "file_name": os.path.basename(dest),
+                "file_size": os.path.getsize(dest),
+                "regno": regno,
+                "fyend": fyend,
+            }
+
     def get_csv_row(row, regno, fyend):
-        source = get_charity_type(regno)
-        accounts = source.list_accounts(regno, session=session)
-        urls = {account.fyend: account.url for account in accounts}
-        if fyend and accounts:
+        if fyend:
             fyend = parse_datetime(fyend)
+            existing = get_existing_file(regno, fyend)
+            if existing:
+                return existing
+
+        source = get_charity_type(regno, limiter=limiter)
+        with limiter.slot(source.name):
+            accounts = source.list_accounts(
+                regno,
+                session=get_thread_session("listing"),
+                refresh=refresh,
+            )
+        if not accounts:
+            raise CharityFetchError("No accounts found for charity {}".format(regno))
+        if fyend:
+            urls = {account.fyend: account.url for account in accounts}
             if fyend not in urls:
                 raise CharityFetchError("Financial year end not found")
+            url = urls[fyend]
+        else:
+            url = accounts[0].url
+            fyend = accounts[0].fyend
+            existing = get_existing_file(regno, fyend)
+            if existing:
+                return existing
+        with limiter.slot(source.name):
             return download_account(
-                urls[fyend],
+                url,
                 regno=regno,
                 fyend=fyend,
                 destination=destination,
-                session=session,
+                session=get_thread_session("pdf"),
             )
-        elif accounts:
-            return download_account(
-                accounts[0].url,
-                regno=regno,
-                fyend=accounts[0].fyend,
-                destination=destination,
-                session=session,
-            )
-        raise CharityFetchError("No accounts found for charity {}".format(regno))
+
+    def process_row(row):
+        regno = row[regno_column]
+        fyend = row.get(fyend_column)
+
+        try:
+            with app.app_context():
+                return get_csv_row(row, regno, fyend)
+        except Exception as err:
+            record_error("fetch", err)
+            return {
+                "error": str(err),
+                "regno": regno,
+                "fyend": fyend,
+            }
 
     def write_logfile(row, mode="a"):
         if logfile:
@@ -430,47 +934,318 @@ def download_from_csv(
             logf = sys.stdout
         writer = csv.writer(logf)
         writer.writerow(row)
-        logf.close()
+        if logfile:
+            logf.close()
 
-    for k, row in tqdm(enumerate(reader)):
+    # look up CCEW organisation numbers in bulk rather than one row at a time
+    ccew_regnos = [
+        row[regno_column]
+        for k, row in rows
+        if row.get(regno_column) and get_regulator(row[regno_column]) is CCEW
+    ]
+    if ccew_regnos:
+        get_charity_type(ccew_regnos[0], limiter=limiter).load_organisation_numbers(
+            ccew_regnos, progress=True
+        )
 
-        if k == 0:
+    # when resuming, carry on adding to the existing log
+    if not (resume and logfile and os.path.exists(logfile)):
+        write_logfile(
+            [h for h in (reader.fieldnames or []) if h not in logging_fields]
+            + logging_fields,
+            mode="w",
+        )
+
+    # rows are fetched in worker threads, but the log is only written from
+    # here so each line is written whole, as soon as its row is finished
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=len(rows)
+    ) as progress:
+        futures = {executor.submit(process_row, row): (k, row) for k, row in rows}
+        for future in as_completed(futures):
+            k, row = futures[future]
+            result = future.result()
             write_logfile(
-                [h for h in row.keys() if h not in logging_fields] + logging_fields,
-                mode="w",
+                [v for h, v in row.items() if h not in logging_fields]
+                + [
+                    result.get("file_location") is not None,
+                    result.get("error"),
+                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    result.get("file_location"),
+                    result.get("file_name"),
+                    result.get("file_size"),
+                    result.get("download_timetaken"),
+                    result.get("download_ttfb"),
+                    result.get("download_bytes_per_second"),
+                    result.get("regno"),
+                    result.get("fyend"),
+                ]
             )
+            if journal:
+                journal.record(k, row[regno_column], result)
+            progress.update()
+
+    if journal:
+        journal.close()
+
+    listing_cache = get_listing_cache()
+    if listing_cache:
+        click.echo(
+            "Listing cache: {hits} hits, {misses} misses".format(
+                **listing_cache.stats()
+            ),
+            err=True,
+        )
 
-        regno = row[regno_column]
-        fyend = row.get(fyend_column)
 
-        if skip_rows and skip_rows > k:
-            result = {
-                "error": "Row skipped",
-                "regno": regno,
-                "fyend": fyend,
-            }
+def sync_charity(
+    regno: str,
+    destination: str,
+    existing_files: set,
+    es=None,
+    index: str = None,
+    dry_run: bool = False,
+    refresh: bool = False,
+    session=None,
+    pdf_session=None,
+    limiter=None,
+) -> dict:
+    """
+    Fetch the accounts for a charity that aren't already in `destination`
 
-        else:
+    `existing_files` is the names of the files in `destination`. If `es`
+    is given then accounts already in `index` are skipped too, and new
+    accounts (or files on disk that haven't been indexed) are uploaded.
+    If `dry_run` is set then nothing is fetched, but the result shows what
+    would be.
+    """
+    result = {
+        "regno": regno,
+        "listed": 0,
+        "existing": 0,
+        "downloaded": [],
+        "indexed": [],
+        "errors": [],
+    }
+    limiter = limiter or HostLimiter()
+    source = get_charity_type(regno, limiter=limiter)
+    with limiter.slot(source.name):
+        accounts = source.list_accounts(regno, session=session, refresh=refresh)
+    result["listed"] = len(accounts)
+
+    indexed = set()
+    if es is not None:
+        indexed = {
+            charity["fye"]
+            for filepath, charity, exists in check_existing(
+                es, index, [(None, {"regno": regno, "fye": a.fyend}) for a in accounts]
+            )
+            if exists
+        }
+
+    for account in accounts:
+        filename = get_account_filename(regno, account.fyend)
+        path = os.path.join(destination, filename)
+        on_disk = filename in existing_files and is_valid_pdf(path)
+        if account.fyend in indexed or (on_disk and es is None):
+            result["existing"] += 1
+            continue
+        if dry_run:
+            if not on_disk:
+                result["downloaded"].append(account.fyend)
+            if es is not None:
+                result["indexed"].append(account.fyend)
+            continue
+
+        if not on_disk:
+            try:
+                with limiter.slot(source.name):
+                    download = download_account(
+                        account.url,
+                        regno=regno,
+                        fyend=account.fyend,
+                        destination=destination,
+                        session=pdf_session,
+                    )
+            except Exception as err:
+                record_error("fetch", err)
+                download = {"error": str(err)}
+            if download.get("error"):
+                result["errors"].append((account.fyend, download["error"]))
+                continue
+            result["downloaded"].append(account.fyend)
+
+        if es is not None:
+            if os.path.getsize(path) > current_app.config["FILE_SIZE_LIMT"]:
+                result["errors"].append((account.fyend, "File too big to upload"))
+                continue
             try:
-                result = get_csv_row(row, regno, fyend)
+                with open(path, "rb") as f:
+                    upload = upload_doc(
+                        {"regno": regno, "fye": account.fyend}, f.read(), es
+                    )
             except Exception as err:
-                result = {
-                    "error": str(err),
-                    "regno": regno,
-                    "fyend": fyend,
-                }
+                record_error("upload", err)
+                upload = {"result": "error", "error": str(err)}
+            if upload.get("result") == "error":
+                result["errors"].append((account.fyend, upload["error"]))
+                continue
+            result["indexed"].append(account.fyend)
+    return result
 
-        write_logfile(
-            [v for h, v in row.items() if h not in logging_fields]
-            + [
-                result.get("file_location") is not None,
-                result.get("error"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                result.get("file_location"),
-                result.get("file_name"),
-                result.get("file_size"),
-                result.get("download_timetaken"),
-                result.get("regno"),
-                result.get("fyend"),
-            ]
+
+@fetch_cli.command("sync")
+@click.argument("regnos", nargs=-1)
+@click.option(
+    "--regno-file",
+    type=click.File("r"),
+    help="File with a charity number on each line",
+)
+@click.option(
+    "--destination",
+    type=click.Path(),
+    default=".",
+    help="Folder in which to save accounts",
+)
+@click.option(
+    "--index/--no-index",
+    "index_accounts",
+    default=False,
+    help="""Upload new accounts to elasticsearch, and skip accounts that
+    are already there""",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Show which accounts would be fetched, without fetching them",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of charities to check at the same time",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of accounts again rather than using the cache",
+)
+@push_metrics_after
+def sync_accounts(
+    regnos,
+    regno_file=None,
+    destination: str = ".",
+    index_accounts: bool = False,
+    dry_run: bool = False,
+    workers: int = 1,
+    refresh: bool = False,
+):
+    """Fetch only the accounts that are new for each charity in REGNOS.
+
+    \b
+    Accounts already saved in --destination as REGNO_YYYYMMDD.pdf (or in
+    elasticsearch, when using --index) are not fetched again.
+    """
+    regnos = list(regnos)
+    if regno_file:
+        regnos += [line.strip() for line in regno_file if line.strip()]
+    regnos = list(dict.fromkeys(regnos))
+    if not regnos:
+        raise click.UsageError("Give at least one charity number")
+
+    existing_files = (
+        set(os.listdir(destination)) if os.path.isdir(destination) else set()
+    )
+    es = get_db() if index_accounts else None
+    index = current_app.config["ES_INDEX"]
+    app = current_app._get_current_object()
+    limiter = HostLimiter(DEFAULT_HOST_LIMITS)
+    thread_data = threading.local()
+
+    def get_thread_session(policy):
+        # sessions aren't shared between threads
+        if not hasattr(thread_data, policy):
+            setattr(thread_data, policy, get_session(policy))
+        return getattr(thread_data, policy)
+
+    def process_regno(regno):
+        try:
+            with app.app_context():
+                return sync_charity(
+                    regno,
+                    destination,
+                    existing_files,
+                    es=es,
+                    index=index,
+                    dry_run=dry_run,
+                    refresh=refresh,
+                    session=get_thread_session("listing"),
+                    pdf_session=get_thread_session("pdf"),
+                    limiter=limiter,
+                )
+        except Exception as err:
+            record_error("fetch", err)
+            return {
+                "regno": regno,
+                "listed": 0,
+                "existing": 0,
+                "downloaded": [],
+                "indexed": [],
+                "errors": [(None, str(err))],
+            }
+
+    # look up CCEW organisation numbers in bulk rather than one at a time
+    ccew_regnos = [regno for regno in regnos if get_regulator(regno) is CCEW]
+    if ccew_regnos:
+        get_charity_type(ccew_regnos[0], limiter=limiter).load_organisation_numbers(
+            ccew_regnos, progress=True
         )
+
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor, tqdm(
+        total=len(regnos), disable=None
+    ) as progress:
+        futures = [executor.submit(process_regno, regno) for regno in regnos]
+        for future in as_completed(futures):
+            results.append(future.result())
+            progress.update()
+
+    fetched = "would be" if dry_run else "were"
+    for result in sorted(results, key=lambda r: regnos.index(r["regno"])):
+        for action in ("downloaded", "indexed"):
+            if result[action]:
+                click.echo(
+                    "{}: {} accounts {} {} ({})".format(
+                        result["regno"],
+                        len(result[action]),
+                        fetched,
+                        action,
+                        ", ".join("{:%Y-%m-%d}".format(f) for f in result[action]),
+                    )
+                )
+        for fyend, error in result["errors"]:
+            click.echo(
+                click.style(
+                    "{}{}: {}".format(
+                        result["regno"],
+                        " ({:%Y-%m-%d})".format(fyend) if fyend else "",
+                        error,
+                    ),
+                    fg="red",
+                ),
+                err=True,
+            )
+
+    click.echo(
+        "{charities} charities: {listed} accounts listed, {existing} already "
+        "held, {downloaded} {fetched} downloaded, {indexed} {fetched} indexed, "
+        "{errors} errors".format(
+            charities=len(results),
+            listed=sum(r["listed"] for r in results),
+            existing=sum(r["existing"] for r in results),
+            downloaded=sum(len(r["downloaded"]) for r in results),
+            indexed=sum(len(r["indexed"]) for r in results),
+            errors=sum(len(r["errors"]) for r in results),
+            fetched=fetched,
+        )
+    )
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from flask import current_app, has_app_context
+
+from docdisplay.metrics import record_cache
+from docdisplay.throttle import mount_rate_limiter
+
+# how responses are cached for each class of traffic - a policy of None
+# means responses aren't cached
+DEFAULT_HTTP_CACHE_POLICIES = {
+    # regulator web pages listing the accounts for a charity
+    "listing": {"expire_after": 60 * 60, "max_entries": 5000},
+    # JSON from the Charity Commission API
+    "api": {"expire_after": 60 * 10, "max_entries": 5000},
+    # PDF files of accounts
+    "pdf": None,
+}
+
+# seconds to connect, and to wait between bytes received, for requests to
+# regulators and the Charity Commission API
+DEFAULT_HTTP_TIMEOUT = (5, 10)
+
+_session_classes = {}
+_session_classes_lock = threading.Lock()
+
+
+class BoundedCacheMixin:
+    """
+    Cached session which limits the number of responses kept
+
+    Used together with `requests_cache.CacheMixin`, which must come after
+    it (see `get_cached_session_class`), and the sqlite backend.
+
+    The key and time of each response saved is kept in an index table
+    alongside the cache, so old responses can be found without loading
+    them. Once more than `max_entries` responses have been saved, expired
+    responses are removed and then the oldest until there are
+    `max_entries` left. The cache is checked after every `max_entries / 10`
+    new responses, rather than every time.
+    """
+
+    index_table = "response_index"
+
+    def __init__(self, *args, max_entries: int = None, policy: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_entries = max_entries
+        self.policy = policy
+        self._saved = 0
+        if self.max_entries:
+            with self.cache.responses.connection(commit=True) as con:
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS {} "
+                    "(key TEXT PRIMARY KEY, created_at REAL NOT NULL)".format(
+                        self.index_table
+                    )
+                )
+                con.execute(
+                    "CREATE INDEX IF NOT EXISTS {0}_created_at "
+                    "ON {0} (created_at)".format(self.index_table)
+                )
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        from_cache = getattr(response, "from_cache", False)
+        record_cache("http_{}".format(self.policy), from_cache)
+        if self.max_entries and not from_cache:
+            self.index_response(self.cache.create_key(request, **kwargs))
+            self._saved += 1
+            if self._saved >= max(self.max_entries // 10, 1):
+                self._saved = 0
+                self.trim()
+        return response
+
+    def index_response(self, key: str):
+        with self.cache.responses.connection(commit=True) as con:
+            con.execute(
+                "REPLACE INTO {} (key, created_at) VALUES (?, ?)".format(
+                    self.index_table
+                ),
+                (key, time.time()),
+            )
+
+    def trim(self):
+        from requests_cache.cache_control import get_expiration_seconds
+
+        expire_after = get_expiration_seconds(self.expire_after)
+        cutoff = time.time() - expire_after if expire_after > 0 else 0
+        tables = {
+            "index": self.index_table,
+            "responses": self.cache.responses.table_name,
+            "redirects": self.cache.redirects.table_name,
+        }
+        # expired responses, and any beyond the newest `max_entries`
+        stale = (
+            "SELECT key FROM {index} WHERE created_at < ? "
+            "UNION SELECT key FROM "
+            "(SELECT key FROM {index} ORDER BY created_at DESC LIMIT -1 OFFSET ?)"
+        ).format(**tables)
+        with self._lock, self.cache.responses.connection(commit=True) as con:
+            # responses saved before the index existed are treated as oldest,
+            # and keys for responses that weren't saved are dropped
+            con.execute(
+                "INSERT OR IGNORE INTO {index} (key, created_at) "
+                "SELECT key, 0 FROM {responses}".format(**tables)
+            )
+            con.execute(
+                "DELETE FROM {index} WHERE key NOT IN "
+                "(SELECT key FROM {responses})".format(**tables)
+            )
+            params = (cutoff, self.max_entries)
+            con.execute(
+                "DELETE FROM {redirects} WHERE value IN ({stale})".format(
+                    stale=stale, **tables
+                ),
+                params,
+            )
+            removed = con.execute(
+                "DELETE FROM {responses} WHERE key IN ({stale})".format(
+                    stale=stale, **tables
+                ),
+                params,
+            ).rowcount
+            con.execute(
+                "DELETE FROM {index} WHERE key IN ({stale})".format(
+                    stale=stale, **tables
+                ),
+                params,
+            )
+        if removed:
+            logging.debug("Removed {} responses from the HTTP cache".format(removed))
+
+
+def get_cached_session_class(session_class):
+    # requests_cache is slow to import, so is only loaded once a cached
+    # session is needed
+    from requests_cache import CacheMixin
+
+    with _session_classes_lock:
+        if session_class not in _session_classes:
+            _session_classes[session_class] = type(
+                "Cached" + session_class.__name__,
+                (BoundedCacheMixin, CacheMixin, session_class),
+                {},
+            )
+    return _session_classes[session_class]
+
+
+def get_timeout():
+    """
+    Get the (connect, read) timeout for requests to other websites
+
+    Requests made for a page keep running after the page stops waiting for
+    them, so they always need a timeout to free up their thread.
+    """
+    if has_app_context():
+        return current_app.config.get("HTTP_TIMEOUT", DEFAULT_HTTP_TIMEOUT)
+    return DEFAULT_HTTP_TIMEOUT
+
+
+def get_policy(name: str) -> dict:
+    policies = DEFAULT_HTTP_CACHE_POLICIES
+    if has_app_context():
+        policies = current_app.config.get("HTTP_CACHE_POLICIES", policies)
+    return policies.get(name)
+
+
+def get_session(policy: str, session_class=requests.Session, **kwargs):
+    """
+    Create a session which caches responses using a policy
+
+    `policy` names one of `HTTP_CACHE_POLICIES` (eg "listing" or "pdf").
+    Each policy has its own cache, so large responses don't push out small
+    ones. If the policy is None, or there is no app, then a normal session
+    is returned.
+
+    Requests that aren't answered from the cache go through the app's rate
+    limiter (see `docdisplay.throttle`).
+    """
+    settings = get_policy(policy)
+    if not has_app_context():
+        return session_class(**kwargs)
+    if settings:
+        cache_path = current_app.config["HTTP_CACHE_PATH"]
+        os.makedirs(cache_path, exist_ok=True)
+        session = get_cached_session_class(session_class)(
+            cache_name=os.path.join(cache_path, policy),
+            policy=policy,
+            **{"backend": "sqlite", **settings},
+            **kwargs,
+        )
+    else:
+        session = session_class(**kwargs)
+    return mount_rate_limiter(session)
@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+
+
+class FetchJournal:
+    """
+    Durable record of the outcome of each row of a `fetch csv` job
+
+    Each finished row is appended to the journal as a line of JSON and
+    flushed to disk straight away, so a crashed job can be resumed with
+    only the unfinished or failed rows.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.entries = {}
+        if resume and os.path.exists(path):
+            self.entries = self._read()
+        self._file = open(path, "a" if resume else "w", encoding="utf8")
+
+    def _read(self) -> dict:
+        """
+        Read the journal, removing any incomplete last line
+
+        If the job crashed while writing a line, the next line would be
+        appended to the end of it and couldn't be read, so the file is
+        truncated to the end of the last complete line.
+        """
+        entries = {}
+        end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logging.warning("Removing incomplete journal line: {}".format(line))
+                    break
+                end += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring invalid journal line: {}".format(line))
+                    continue
+                entries[(entry["row"], entry["regno"])] = entry
+        if end < os.path.getsize(self.path):
+            with open(self.path, "rb+") as f:
+                f.truncate(end)
+        return entries
+
+    def is_done(self, row: int, regno: str) -> bool:
+        entry = self.entries.get((row, regno))
+        return bool(entry and entry["success"])
+
+    def record(self, row: int, regno: str, result: dict):
+        entry = {
+            "row": row,
+            "regno": regno,
+            "success": result.get("file_location") is not None,
+            "error": result.get("error"),
+            "file_location": result.get("file_location"),
+            "fyend": str(result["fyend"]) if result.get("fyend") else None,
+        }
+        self.entries[(row, regno)] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,164 @@
+import functools
+import logging
+import os
+import time
+
+import click
+from flask import Response, current_app, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    push_to_gateway,
+)
+
+LISTING_FETCH_SECONDS = Histogram(
+    "docdisplay_listing_fetch_seconds",
+    "Time taken to fetch the page listing the accounts for a charity",
+    ["regulator"],
+)
+LISTING_PARSE_SECONDS = Histogram(
+    "docdisplay_listing_parse_seconds",
+    "Time taken to find the accounts in a listing page",
+    ["regulator"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+DOWNLOAD_BYTES = Histogram(
+    "docdisplay_download_bytes",
+    "Size of each PDF downloaded",
+    buckets=[1024 * kb for kb in (100, 250, 500, 1024, 2048, 5120, 10240, 51200)],
+)
+DOWNLOAD_SECONDS = Histogram(
+    "docdisplay_download_seconds",
+    "Time taken to download each PDF",
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+EXTRACT_SECONDS_PER_PAGE = Histogram(
+    "docdisplay_extract_seconds_per_page",
+    "Time taken to extract the text from a PDF, divided by its pages",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+PAGES_EXTRACTED = Counter(
+    "docdisplay_pages_extracted",
+    "Number of PDF pages that text was extracted from",
+)
+ES_REQUEST_SECONDS = Histogram(
+    "docdisplay_es_request_seconds",
+    "Time taken by each call to elasticsearch, including retries",
+    ["endpoint"],
+)
+ES_TOOK_SECONDS = Histogram(
+    "docdisplay_es_took_seconds",
+    "Time elasticsearch reports it took to run each call",
+    ["endpoint"],
+)
+REQUEST_SECONDS = Histogram(
+    "docdisplay_request_seconds",
+    "Time taken to respond to each request to the app",
+    ["method", "endpoint", "status"],
+)
+CACHE_REQUESTS = Counter(
+    "docdisplay_cache_requests",
+    "Number of lookups in each cache",
+    ["cache", "result"],
+)
+HTTP_RETRIES = Counter(
+    "docdisplay_http_retries",
+    "Number of requests to other websites retried, by host and reason",
+    ["host", "reason"],
+)
+ERRORS = Counter(
+    "docdisplay_errors",
+    "Number of errors at each stage, by type",
+    ["stage", "type"],
+)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_error(stage: str, error):
+    """
+    Count an error, given either the exception or the name of its type
+    """
+    if isinstance(error, BaseException):
+        error = type(error).__name__
+    ERRORS.labels(stage, error).inc()
+
+
+def record_retry(host: str, reason: str):
+    HTTP_RETRIES.labels(host, reason).inc()
+
+
+def get_registry():
+    """
+    Get the metrics to report
+
+    If `PROMETHEUS_MULTIPROC_DIR` is set (eg when running under gunicorn
+    with more than one worker) then the metrics of every process are
+    collected from there.
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_response() -> Response:
+    return Response(generate_latest(get_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+def push_metrics(job: str):
+    """
+    Send the metrics to the Prometheus pushgateway, if one is configured
+    """
+    gateway = current_app.config.get("PROMETHEUS_PUSHGATEWAY")
+    if not gateway:
+        return
+    try:
+        push_to_gateway(gateway, job=job, registry=get_registry())
+    except OSError as err:
+        logging.warning("Could not push metrics to {}: {}".format(gateway, err))
+
+
+def push_metrics_after(f):
+    """
+    Push the metrics once a command has finished, whether or not it worked
+
+    The job is named after the command, eg `fetch_csv` for `flask fetch csv`.
+    """
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        finally:
+            command_path = click.get_current_context().command_path.split()
+            push_metrics("_".join(command_path[1:]) or command_path[0])
+
+    return wrapper
+
+
+def init_app(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        if "request_start" in g:
+            REQUEST_SECONDS.labels(
+                request.method, request.endpoint or "none", response.status_code
+            ).observe(time.perf_counter() - g.request_start)
+        return response
+
+    @app.teardown_request
+    def record_request_error(err):
+        if err is not None:
+            record_error("request", err)
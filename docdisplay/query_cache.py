@@ -0,0 +1,237 @@
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+from docdisplay.cache import SQLiteStore
+from docdisplay.metrics import record_cache
+
+_create_lock = threading.Lock()
+
+GENERATION_KEY = "__generation__"
+
+
+class SQLiteQueryCacheBackend(SQLiteStore):
+    """
+    Query cache shared between processes on the same machine
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS query_cache (
+            key TEXT NOT NULL PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires REAL
+        )
+    """
+
+    # remove expired entries after this many new entries
+    purge_every = 500
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._sets = 0
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM query_cache "
+                "WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._conn.execute(
+                "REPLACE INTO query_cache (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+            self._sets += 1
+            if self._sets % self.purge_every == 0:
+                self._conn.execute(
+                    "DELETE FROM query_cache WHERE expires < ?", (time.time(),)
+                )
+
+    def get_generation(self) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM query_cache WHERE key = ?", (GENERATION_KEY,)
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def bump_generation(self) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT value FROM query_cache WHERE key = ?", (GENERATION_KEY,)
+                ).fetchone()
+                generation = (int(row[0]) if row else 0) + 1
+                self._conn.execute(
+                    "REPLACE INTO query_cache (key, value, expires) VALUES (?, ?, NULL)",
+                    (GENERATION_KEY, str(generation)),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return generation
+
+
+QUERY_CACHE_BACKENDS = {
+    "sqlite": SQLiteQueryCacheBackend,
+}
+
+
+class QueryCache:
+    """
+    Cache of elasticsearch responses
+
+    Responses are kept in memory in a least recently used cache of up to
+    `maxsize` entries, and in the `backend` if one is given so they can be
+    shared with other processes. Entries expire after `ttl` seconds.
+
+    Every key includes a generation number. Bumping the generation when
+    documents are added means older entries are never used again.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 300, backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_generation(self) -> int:
+        if self.backend:
+            return self.backend.get_generation()
+        return self.generation
+
+    def bump_generation(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+        if self.backend:
+            self.backend.bump_generation()
+
+    def make_key(self, namespace: str, params: dict) -> str:
+        params = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+        key = "{}:{}:{}".format(namespace, self.get_generation(), params)
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                record_cache("query", True)
+                return entry[0]
+        value = self.backend.get(key) if self.backend else None
+        record_cache("query", value is not None)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._set_local(key, value)
+        return value
+
+    def _set_local(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def set(self, key: str, value: str):
+        self._set_local(key, value)
+        if self.backend:
+            self.backend.set(key, value, self.ttl)
+
+    def cached(self, namespace: str, func, **kwargs):
+        """
+        Get the result of `func(**kwargs)`, from the cache if possible
+
+        Results are stored as JSON, so each caller gets its own copy.
+        """
+        key = self.make_key(namespace, kwargs)
+        value = self.get(key)
+        if value is None:
+            value = json.dumps(func(**kwargs), default=str)
+            self.set(key, value)
+        return json.loads(value)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "generation": self.get_generation(),
+        }
+
+
+class CachedClient:
+    """
+    Elasticsearch client that caches the results of searches and counts
+
+    Any other method is passed straight to the wrapped client.
+    """
+
+    def __init__(self, es, cache: QueryCache):
+        self.es = es
+        self.cache = cache
+
+    def search(self, **kwargs):
+        return self.cache.cached("search", self.es.search, **kwargs)
+
+    def count(self, **kwargs):
+        return self.cache.cached("count", self.es.count, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.es, name)
+
+
+def get_query_cache():
+    """
+    Get the query cache for this process, or None if it is turned off
+
+    `QUERY_CACHE_BACKEND` is either the name of one of
+    `QUERY_CACHE_BACKENDS` or the import path of another backend class,
+    which is created using `QUERY_CACHE_BACKEND_OPTIONS`.
+    """
+    if not current_app.config.get("QUERY_CACHE_SIZE"):
+        return None
+    with _create_lock:
+        if "query_cache" not in current_app.extensions:
+            backend = current_app.config.get("QUERY_CACHE_BACKEND")
+            if backend:
+                backend = QUERY_CACHE_BACKENDS.get(backend) or import_string(backend)
+                backend = backend(
+                    **current_app.config.get("QUERY_CACHE_BACKEND_OPTIONS", {})
+                )
+            current_app.extensions["query_cache"] = QueryCache(
+                maxsize=current_app.config["QUERY_CACHE_SIZE"],
+                ttl=current_app.config.get("QUERY_CACHE_TTL"),
+                backend=backend,
+            )
+    return current_app.extensions["query_cache"]
+
+
+def clear_query_cache():
+    """
+    Stop any cached results being used, after documents have changed
+    """
+    cache = get_query_cache()
+    if cache is not None:
+        cache.bump_generation()
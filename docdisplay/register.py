@@ -0,0 +1,132 @@
+import csv
+import json
+import logging
+
+# number of charities sent to elasticsearch in each bulk request
+REGISTER_CHUNK_SIZE = 500
+
+
+def read_register(path: str):
+    """
+    Read the rows of a register extract from a CSV, JSON or JSON lines file
+
+    Each row has a `regno` and `name`, and can also have `names` (a list,
+    or names separated by ";" in a CSV file) and finances: either a list of
+    `finances` or a single `fyend`, `income` and `spending`.
+    """
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif path.endswith(".json"):
+        with open(path, encoding="utf8") as f:
+            yield from json.load(f)
+    else:
+        with open(path, encoding="utf8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("names"):
+                    row["names"] = [n.strip() for n in row["names"].split(";")]
+                yield row
+
+
+def get_charities(rows) -> dict:
+    """
+    Put rows together into one document for each charity
+
+    Files can have a row for each financial year of a charity, so rows with
+    the same `regno` are merged.
+    """
+    charities = {}
+    for row in rows:
+        regno = str(row.get("regno") or "").strip()
+        if not regno:
+            logging.warning("Skipping row without a regno: {}".format(row))
+            continue
+        charity = charities.setdefault(
+            regno, {"regno": regno, "name": None, "names": [], "finances": []}
+        )
+        if row.get("name") and not charity["name"]:
+            charity["name"] = row["name"]
+        for name in [row.get("name")] + list(row.get("names") or []):
+            if name and name not in charity["names"]:
+                charity["names"].append(name)
+        finances = row.get("finances") or []
+        if row.get("fyend"):
+            finances = finances + [
+                {
+                    "fyend": row["fyend"],
+                    "income": row.get("income") or None,
+                    "spending": row.get("spending") or None,
+                }
+            ]
+        charity["finances"].extend(finances)
+    for charity in charities.values():
+        charity["finances"] = sorted(
+            {f["fyend"]: f for f in charity["finances"]}.values(),
+            key=lambda f: f["fyend"],
+            reverse=True,
+        )
+    return charities
+
+
+def load_register(es, index: str, charities: dict, chunk_size=REGISTER_CHUNK_SIZE):
+    """
+    Index each charity, keyed by its charity number
+
+    Yields whether each charity was indexed and the bulk response for it.
+    """
+    from elasticsearch.helpers import streaming_bulk
+
+    actions = (
+        {"_index": index, "_type": "_doc", "_id": regno, "_source": charity}
+        for regno, charity in charities.items()
+    )
+    yield from streaming_bulk(es, actions, chunk_size=chunk_size, raise_on_error=False)
+
+
+def get_register_query(q: str) -> dict:
+    return {
+        "bool": {
+            "should": [
+                {"term": {"regno": {"value": q.strip(), "boost": 10}}},
+                {"match": {"names": {"query": q, "operator": "and", "boost": 2}}},
+                {"match": {"names.autocomplete": {"query": q, "operator": "and"}}},
+            ],
+            "minimum_should_match": 1,
+        }
+    }
+
+
+def search_register(es, index: str, q: str, limit=20, skip=0) -> dict:
+    """
+    Search the local copy of the charity register
+
+    Results are in the same format as search results from CharityBase.
+    """
+    result = es.search(
+        index=index,
+        doc_type="_doc",
+        body={"query": get_register_query(q), "from": skip, "size": limit},
+    )
+    count = result.get("hits", {}).get("total", 0)
+    if isinstance(count, dict):
+        count = count.get("value")
+    return {
+        "count": count,
+        "results": [
+            {
+                "id": hit["_source"]["regno"],
+                "names": [{"value": hit["_source"]["name"], "primary": True}],
+                "finances": [
+                    {
+                        "financialYear": {"end": f["fyend"]},
+                        "income": f.get("income"),
+                        "spending": f.get("spending"),
+                    }
+                    for f in hit["_source"].get("finances", [])
+                ],
+            }
+            for hit in result.get("hits", {}).get("hits", [])
+        ],
+    }
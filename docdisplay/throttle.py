@@ -0,0 +1,289 @@
+import datetime
+import email.utils
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+from docdisplay.metrics import record_retry
+
+# number of concurrent requests allowed to each regulator by default
+DEFAULT_HOST_LIMITS = {
+    "ccew": 2,
+    "ccni": 2,
+    "oscr": 2,
+    "ccapi": 4,
+}
+
+
+class HostLimiter:
+    """
+    Cap the number of concurrent requests made to each regulator
+
+    Each key (eg "ccew" or "ccapi") gets its own semaphore. Keys without
+    a limit are not restricted, so `HostLimiter()` does nothing.
+    """
+
+    def __init__(self, limits: dict = None):
+        self.limits = limits or {}
+        self._semaphores = {
+            key: threading.BoundedSemaphore(limit)
+            for key, limit in self.limits.items()
+            if limit
+        }
+
+    @contextmanager
+    def slot(self, key: str):
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+
+# requests per second allowed to each host. The rate goes up slowly while
+# requests succeed and is halved whenever the host asks us to slow down,
+# staying between `min_rate` and `max_rate`. `burst` is the number of
+# requests that can be sent at once after a quiet spell.
+DEFAULT_HOST_RATES = {
+    "register-of-charities.charitycommission.gov.uk": {"rate": 2, "max_rate": 5},
+    "api.charitycommission.gov.uk": {"rate": 4, "max_rate": 10},
+    "www.charitycommissionni.org.uk": {"rate": 2, "max_rate": 5},
+    "apps.charitycommission.gov.uk": {"rate": 2, "max_rate": 5},
+    "www.oscr.org.uk": {"rate": 2, "max_rate": 5},
+}
+
+# responses which mean the host is overloaded, so the request is retried
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# methods which are safe to send again after an error
+RETRY_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_create_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Limit the rate of requests to a host, adjusting it to how the host copes
+
+    A token is needed for each request, and tokens are added at `rate` per
+    second up to `burst`. The rate is raised by `increase` after each
+    success and multiplied by `decrease` when the host pushes back
+    (additive increase, multiplicative decrease). A `Retry-After` from the
+    host stops all requests to it until that time has passed.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int = 1,
+        min_rate: float = 0.5,
+        max_rate: float = None,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.blocked_until = 0
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Wait until a request can be sent
+        """
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttle(self, retry_after: float = None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, self.clock() + retry_after)
+
+
+class RateLimiter:
+    """
+    Token bucket for each host, created the first time the host is used
+
+    Hosts not in `rates` aren't limited.
+    """
+
+    def __init__(self, rates: dict = None):
+        self.rates = rates or {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, host: str) -> TokenBucket:
+        if host not in self.rates:
+            return None
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(**self.rates[host])
+        return self._buckets[host]
+
+
+def get_backoff(attempt: int, factor: float = 1, maximum: float = 60) -> float:
+    """
+    Time to wait before a retry: exponential backoff with full jitter
+    """
+    return random.uniform(0, min(maximum, factor * (2**attempt)))
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Get the number of seconds to wait from a `Retry-After` header
+
+    The header is either a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(
+        (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0
+    )
+
+
+class RateLimitAdapter(HTTPAdapter):
+    """
+    Send requests through each host's token bucket, retrying when it pushes back
+
+    Requests using one of `RETRY_METHODS` that get a response in
+    `RETRY_STATUSES`, or fail to connect, are retried up to `retries` times.
+    Other requests, eg POST, aren't sent again in case they have already
+    had an effect, though a response in `RETRY_STATUSES` still slows down
+    the host's bucket. A `Retry-After`
+    header (up to `max_retry_after` seconds) sets the wait before the
+    retry, otherwise the wait is a jittered exponential backoff. The last
+    response is returned, or the last error raised, once the retries run
+    out.
+    """
+
+    def __init__(
+        self,
+        limiter: RateLimiter,
+        retries: int = 3,
+        backoff_factor: float = 1,
+        max_retry_after: float = 120,
+        sleep=time.sleep,
+        **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.sleep = sleep
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).hostname
+        bucket = self.limiter.get_bucket(host)
+        attempt = 0
+        while True:
+            if bucket:
+                bucket.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except requests.exceptions.ConnectionError as err:
+                if attempt >= self.retries or request.method not in RETRY_METHODS:
+                    raise
+                if bucket:
+                    bucket.throttle()
+                record_retry(host, type(err).__name__)
+                wait = get_backoff(attempt, self.backoff_factor)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    if bucket:
+                        bucket.success()
+                    return response
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if retry_after is not None:
+                    retry_after = min(retry_after, self.max_retry_after)
+                if bucket:
+                    bucket.throttle(retry_after)
+                if attempt >= self.retries or request.method not in RETRY_METHODS:
+                    return response
+                response.close()
+                record_retry(host, str(response.status_code))
+                if retry_after is not None:
+                    # the bucket waits for Retry-After before the next request
+                    wait = 0 if bucket else retry_after
+                else:
+                    wait = get_backoff(attempt, self.backoff_factor)
+            attempt += 1
+            logging.debug(
+                "Retrying {} in {:.1f} seconds (attempt {})".format(
+                    request.url, wait, attempt
+                )
+            )
+            if wait:
+                self.sleep(wait)
+
+
+def get_rate_limiter() -> RateLimiter:
+    """
+    Get the rate limiter shared by every session in this process
+    """
+    with _create_lock:
+        if "rate_limiter" not in current_app.extensions:
+            current_app.extensions["rate_limiter"] = RateLimiter(
+                current_app.config.get("HOST_RATE_LIMITS", DEFAULT_HOST_RATES)
+            )
+    return current_app.extensions["rate_limiter"]
+
+
+def mount_rate_limiter(session):
+    """
+    Send all the requests made by a session through the app's rate limiter
+    """
+    adapter = RateLimitAdapter(
+        get_rate_limiter(),
+        retries=current_app.config.get("HTTP_RETRIES", 3),
+        backoff_factor=current_app.config.get("HTTP_BACKOFF_FACTOR", 1),
+        max_retry_after=current_app.config.get("HTTP_MAX_RETRY_AFTER", 120),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
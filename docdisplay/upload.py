@@ -1,41 +1,257 @@
 import base64
+import collections
 import datetime
+import functools
 import io
+import itertools
+import logging
+import math
+import re
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-import pdfplumber
-from elasticsearch.exceptions import NotFoundError
 from flask import current_app
 
+from docdisplay.blobstore import get_blob_store
+from docdisplay.metrics import EXTRACT_SECONDS_PER_PAGE, PAGES_EXTRACTED, record_error
+from docdisplay.query_cache import clear_query_cache
+
+# smallest number of pages to send to each process when extracting in parallel
+MIN_PAGES_PER_BATCH = 5
+
+_extract_pools = {}
+
+# marks the start of each page in the content of a document
+PAGE_MARKER = re.compile(r"<span id='page-(\d+)'></span>\n")
+
+# limits on the size of each bulk request to elasticsearch
+BULK_CHUNK_SIZE = 50
+BULK_MAX_CHUNK_BYTES = 50 * (1024**2)
+
+# number of document ids to check in each request when skipping existing docs
+EXISTS_CHUNK_SIZE = 1000
+
 
 class DocumentUploadError(Exception):
     pass
 
 
-def convert_file(source):
+def extract_pages(source, start: int = 0, end: int = None) -> list:
+    """
+    Extract the text from each page of a PDF, from page `start` up to `end`
+    """
+    import pdfplumber
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
     with pdfplumber.open(source) as pdf:
-        content = "\n\n".join(
-            [
-                "<span id='page-{}'></span>\n{}".format(i, p.extract_text())
-                for i, p in enumerate(pdf.pages)
-                if p.extract_text()
-            ]
-        )
-        if not content:
-            raise DocumentUploadError("No content found in PDF")
-        return {
-            "content": content,
-            "content_length": len(content),
-            "pages": len(pdf.pages),
-            "content_type": "application/pdf",
-            "language": "en",
-            "date": datetime.datetime.now(),
+        return [p.extract_text() for p in pdf.pages[start:end]]
+
+
+def get_extract_pool(workers: int) -> ProcessPoolExecutor:
+    # pools are kept between files to avoid starting new processes each time
+    if workers not in _extract_pools:
+        _extract_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+    return _extract_pools[workers]
+
+
+def extract_pages_parallel(data: bytes, page_count: int, workers: int) -> list:
+    """
+    Extract the text from each page of a PDF using a pool of processes
+
+    The pages are split into batches which are extracted in separate
+    processes, and then put back together in order.
+    """
+    batch_size = max(math.ceil(page_count / (workers * 4)), MIN_PAGES_PER_BATCH)
+    pool = get_extract_pool(workers)
+    batches = pool.map(
+        extract_pages,
+        itertools.repeat(data),
+        range(0, page_count, batch_size),
+        range(batch_size, page_count + batch_size, batch_size),
+    )
+    return list(itertools.chain.from_iterable(batches))
+
+
+def extract_text(source, workers: int = None) -> list:
+    """
+    Extract the text from each page of a PDF
+
+    If `workers` is more than one then pages of large PDFs are extracted
+    in parallel, in that many processes.
+    """
+    # pdfplumber is slow to import, so is only loaded when it is needed
+    import pdfplumber
+
+    start = time.perf_counter()
+    with pdfplumber.open(source) as pdf:
+        page_count = len(pdf.pages)
+        if workers and workers > 1 and page_count >= MIN_PAGES_PER_BATCH * 2:
+            source.seek(0)
+            pages = extract_pages_parallel(source.read(), page_count, workers)
+        else:
+            pages = [p.extract_text() for p in pdf.pages]
+    if page_count:
+        PAGES_EXTRACTED.inc(page_count)
+        EXTRACT_SECONDS_PER_PAGE.observe((time.perf_counter() - start) / page_count)
+    return pages
+
+
+def get_attachment(pages: list) -> dict:
+    """
+    Put the text of each page together into the attachment for a document
+    """
+    content = "\n\n".join(
+        [
+            "<span id='page-{}'></span>\n{}".format(i, text)
+            for i, text in enumerate(pages)
+            if text
+        ]
+    )
+    if not content:
+        raise DocumentUploadError("No content found in PDF")
+    return {
+        "content": content,
+        "content_length": len(content),
+        "pages": len(pages),
+        "content_type": "application/pdf",
+        "language": "en",
+        "date": datetime.datetime.now(),
+    }
+
+
+def split_pages(content: str) -> list:
+    """
+    Split the content of a document back into the text of each page
+    """
+    parts = PAGE_MARKER.split(content)
+    pages = [None] * max([int(p) + 1 for p in parts[1::2]], default=0)
+    for page, text in zip(parts[1::2], parts[2::2]):
+        # pages are separated by a blank line
+        pages[int(page)] = text[:-2] if text.endswith("\n\n") else text
+    return pages
+
+
+def convert_file(source, workers: int = None):
+    """
+    Extract the text from a PDF
+
+    If `workers` is more than one then pages of large PDFs are extracted
+    in parallel, in that many processes.
+    """
+    return get_attachment(extract_text(source, workers=workers))
+
+
+def get_doc_id(charity: dict) -> str:
+    return "{}-{:%Y%m%d}".format(charity["regno"], charity["fye"])
+
+
+def get_page_id(doc_id: str, page: int) -> str:
+    return "{}-{}".format(doc_id, page)
+
+
+def get_page_docs(doc_id: str, charity: dict, pages: list) -> list:
+    """
+    Create a separate document for each page of a PDF that has some text
+
+    Pages are numbered from zero, to match the `page-N` markers in the
+    content of the whole document.
+    """
+    return [
+        {
+            "doc_id": doc_id,
+            "page": i,
+            "regno": charity["regno"],
+            "fye": charity["fye"],
+            "content": text,
+        }
+        for i, text in enumerate(pages)
+        if text
+    ]
+
+
+def prepare_doc(
+    charity: dict, content: bytes, blob_store=None, workers: int = None
+) -> tuple:
+    """
+    Create the elasticsearch documents for a PDF
+
+    Returns the document for the whole PDF and a list of documents for
+    each of its pages. If a blob store is given then the PDF is saved there
+    and the document only records its hash, otherwise the PDF is included
+    in the document.
+    """
+    pages = extract_text(io.BytesIO(content), workers=workers)
+    attachment = get_attachment(pages)
+    if blob_store:
+        file_fields = {
+            "filehash": blob_store.put(content),
+            "filesize": len(content),
+        }
+    else:
+        file_fields = {"filedata": base64.b64encode(content).decode("utf8")}
+    body = {
+        "filename": get_doc_id(charity) + ".pdf",
+        **file_fields,
+        "attachment": attachment,
+        "pages_indexed": True,
+        **charity,
+    }
+    return body, get_page_docs(get_doc_id(charity), charity, pages)
+
+
+def get_page_actions(index: str, page_docs: list):
+    for page_doc in page_docs:
+        yield {
+            "_index": index,
+            "_type": "_doc",
+            "_id": get_page_id(page_doc["doc_id"], page_doc["page"]),
+            "_source": page_doc,
         }
 
 
+def delete_old_pages(es, index: str, doc_id: str, pages: list):
+    """
+    Remove any pages left over from an earlier version of a document
+    """
+    return es.delete_by_query(
+        index=index,
+        doc_type="_doc",
+        body={
+            "query": {
+                "bool": {
+                    "filter": [{"term": {"doc_id": doc_id}}],
+                    "must_not": [{"terms": {"page": pages}}],
+                }
+            }
+        },
+        conflicts="proceed",
+    )
+
+
+def index_pages(es, index: str, doc_id: str, page_docs: list, replace=False):
+    """
+    Index the pages of a document
+
+    If `replace` is true then pages from an earlier version of the document
+    that aren't in this version are removed.
+    """
+    from elasticsearch.helpers import streaming_bulk
+
+    for ok, item in streaming_bulk(
+        es, get_page_actions(index, page_docs), raise_on_error=False
+    ):
+        if not ok:
+            logging.warning("Could not index page: {}".format(item))
+    if replace:
+        delete_old_pages(es, index, doc_id, [p["page"] for p in page_docs])
+
+
 def upload_doc(charity, content, es, skip_if_exists=False):
-    id_ = "{}-{:%Y%m%d}".format(charity["regno"], charity["fye"])
-    filename = id_ + ".pdf"
+    from elasticsearch.exceptions import NotFoundError
+
+    id_ = get_doc_id(charity)
 
     if skip_if_exists:
         try:
@@ -55,8 +271,14 @@ def upload_doc(charity, content, es, skip_if_exists=False):
             pass
 
     try:
-        attachment = convert_file(io.BytesIO(content))
+        body, page_docs = prepare_doc(
+            charity,
+            content,
+            blob_store=get_blob_store(),
+            workers=current_app.config.get("EXTRACT_WORKERS"),
+        )
     except Exception as err:
+        record_error("extract", err)
         exc_type, value, traceback = sys.exc_info()
         return {
             "_index": current_app.config.get("ES_INDEX"),
@@ -66,14 +288,169 @@ def upload_doc(charity, content, es, skip_if_exists=False):
             "error": f"{exc_type.__name__}: {str(err)}",
         }
 
-    return es.index(
+    result = es.index(
         index=current_app.config.get("ES_INDEX"),
         doc_type="_doc",
         id=id_,
-        body={
-            "filename": filename,
-            "filedata": base64.b64encode(content).decode("utf8"),
-            "attachment": attachment,
-            **charity,
-        },
+        body=body,
     )
+    index_pages(
+        es,
+        current_app.config.get("ES_PAGES_INDEX"),
+        id_,
+        page_docs,
+        replace=result.get("result") == "updated",
+    )
+    clear_query_cache()
+    return result
+
+
+def check_existing(es, index: str, files, chunk_size: int = EXISTS_CHUNK_SIZE):
+    """
+    Check which files already have a document in the index
+
+    `files` is an iterable of `(filepath, charity)` pairs. The document ids
+    for each chunk of files are checked with a single `mget` request.
+    Yields `(filepath, charity, exists)` for each file.
+    """
+    files = iter(files)
+    while True:
+        chunk = list(itertools.islice(files, chunk_size))
+        if not chunk:
+            return
+        result = es.mget(
+            index=index,
+            doc_type="_doc",
+            body={"ids": [get_doc_id(charity) for filepath, charity in chunk]},
+            _source=False,
+        )
+        existing = {d["_id"] for d in result.get("docs", []) if d.get("found")}
+        for filepath, charity in chunk:
+            yield filepath, charity, get_doc_id(charity) in existing
+
+
+def prepare_file(filepath, charity: dict, blob_store=None):
+    """
+    Read a PDF file and create its elasticsearch document
+
+    This runs in a separate process, so any error is returned as a message
+    rather than raised.
+    """
+    try:
+        with open(filepath, "rb") as pdffile:
+            body, page_docs = prepare_doc(
+                charity, pdffile.read(), blob_store=blob_store
+            )
+            return body, page_docs, None
+    except Exception as err:
+        return None, None, f"{type(err).__name__}: {str(err)}"
+
+
+def bounded_submit(pool, func, items, window: int):
+    """
+    Submit `func(*item)` to the pool for each item, in order
+
+    Only `window` tasks are in progress at once, so results that haven't
+    been used yet don't build up in memory.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, pool.submit(func, *item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def bulk_upload(
+    es,
+    index: str,
+    files,
+    pages_index: str = None,
+    workers: int = 1,
+    chunk_size: int = BULK_CHUNK_SIZE,
+    max_chunk_bytes: int = BULK_MAX_CHUNK_BYTES,
+    blob_store=None,
+):
+    """
+    Upload PDF files to elasticsearch using bulk requests
+
+    `files` is an iterable of `(filepath, charity)` pairs. Text is
+    extracted in `workers` processes, and the documents are sent in
+    bulk requests of up to `chunk_size` documents or `max_chunk_bytes`.
+    If `pages_index` is given then the pages of each document are sent
+    to that index in the same bulk requests.
+
+    Yields the filepath and a result for each file, in the same format
+    as the results of `upload_doc`.
+    """
+    from elasticsearch.helpers import streaming_bulk
+
+    failed = collections.deque()
+    filepaths = collections.defaultdict(collections.deque)
+    doc_pages = {}
+    page_ids = set()
+
+    def generate_actions():
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (filepath, charity), future in bounded_submit(
+                pool,
+                functools.partial(prepare_file, blob_store=blob_store),
+                files,
+                workers * 2,
+            ):
+                body, page_docs, error = future.result()
+                id_ = get_doc_id(charity)
+                if error:
+                    record_error("extract", error.split(":", 1)[0])
+                    failed.append(
+                        (
+                            filepath,
+                            {
+                                "_index": index,
+                                "_type": "_doc",
+                                "_id": id_,
+                                "result": "error",
+                                "error": error,
+                            },
+                        )
+                    )
+                    continue
+                filepaths[id_].append(filepath)
+                yield {"_index": index, "_type": "_doc", "_id": id_, "_source": body}
+                if pages_index:
+                    doc_pages[id_] = [p["page"] for p in page_docs]
+                    for action in get_page_actions(pages_index, page_docs):
+                        page_ids.add(action["_id"])
+                        yield action
+
+    for ok, item in streaming_bulk(
+        es,
+        generate_actions(),
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        raise_on_error=False,
+        raise_on_exception=False,
+    ):
+        while failed:
+            yield failed.popleft()
+        op_type, info = item.popitem()
+        if info.get("_id") in page_ids:
+            page_ids.discard(info["_id"])
+            if not ok:
+                logging.warning("Could not index page: {}".format(info))
+            continue
+        result = {
+            "_index": info.get("_index"),
+            "_type": info.get("_type"),
+            "_id": info.get("_id"),
+            "result": info.get("result") if ok else "error",
+        }
+        if not ok:
+            result["error"] = info.get("error")
+        pages = doc_pages.pop(info.get("_id"), None)
+        if ok and pages is not None and result["result"] == "updated":
+            delete_old_pages(es, pages_index, info.get("_id"), pages)
+        yield filepaths[info.get("_id")].popleft(), result
+    while failed:
+        yield failed.popleft()
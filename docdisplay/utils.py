@@ -1,3 +1,6 @@
+import base64
+import binascii
+import json
 import math
 from datetime import date, datetime
 
@@ -28,7 +31,36 @@ def parse_datetime(d: str, f: str = "%Y-%m-%d", output_format=None) -> date:
     return d
 
 
-def get_nav(p, limit, result_count, url_base, url_args):
+def encode_cursor(cursor: dict) -> str:
+    """
+    Turn a pagination cursor into an opaque string that can go in a URL
+    """
+    cursor = json.dumps(cursor, separators=(",", ":")).encode("utf8")
+    return base64.urlsafe_b64encode(cursor).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Read a cursor made by `encode_cursor`, or an empty dict if it isn't valid
+    """
+    if not cursor:
+        return {}
+    try:
+        cursor = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor = json.loads(cursor)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return {}
+    return cursor if isinstance(cursor, dict) else {}
+
+
+def get_nav(p, limit, result_count, url_base, url_args, results=None):
+    """
+    Get the links to other pages of results
+
+    If `results` is given then links use a cursor based on the `sort`
+    values of the first and last results, for use with `search_after`,
+    rather than a page number.
+    """
     nav = {
         "first_result": ((p - 1) * limit) + 1,
         "last_result": min([p * limit, result_count]),
@@ -37,6 +69,26 @@ def get_nav(p, limit, result_count, url_base, url_args):
         "last_page": math.ceil(result_count / limit),
     }
 
+    if results is not None:
+
+        def page_url(cursor=None):
+            if cursor is None:
+                return url_for(url_base, **url_args)
+            return url_for(url_base, **url_args, cursor=encode_cursor(cursor))
+
+        if result_count > nav["last_result"] and results:
+            nav["last"] = page_url({"p": nav["last_page"], "reverse": True})
+            nav["next"] = page_url({"p": p + 1, "after": results[-1]["sort"]})
+        if p >= 2:
+            nav["first"] = page_url()
+            if p == 2 or not results:
+                nav["prev"] = page_url()
+            else:
+                nav["prev"] = page_url(
+                    {"p": p - 1, "after": results[0]["sort"], "reverse": True}
+                )
+        return nav
+
     if result_count > nav["last_result"]:
         nav["last"] = url_for(url_base, **url_args, p=nav["last_page"])
         nav["next"] = url_for(url_base, **url_args, p=p + 1)